@@ -13,10 +13,12 @@ Map Reduce (EMR) or a local Hadoop cluster.
 
 """
 
+import platform
+
 from mrjob.job import MRJob
 from mrjob.protocol import RawValueProtocol
 
-from core import Process
+from core import Process, BACKENDS
 
 
 class ProcessPhyloData(MRJob, Process):
@@ -35,6 +37,81 @@ class ProcessPhyloData(MRJob, Process):
                 help='Number of bootstrap replicates to generate'
             )
 
+        self.add_passthrough_option(
+                '--seed',
+                dest='seed',
+                default=None,
+                type='int',
+                help='Seed for bootstrap resampling, so replicates can be regenerated'
+            )
+
+        self.add_passthrough_option(
+                '--model-threads',
+                dest='model_threads',
+                default=1,
+                type='int',
+                help='Number of substitution models to run concurrently during model selection'
+            )
+
+        self.add_passthrough_option(
+                '--model-selection',
+                dest='model_selection',
+                default='exhaustive',
+                type='choice',
+                choices=['exhaustive', 'hierarchical'],
+                help='Run all models, or walk the nested models skipping those that cannot have the best AICc'
+            )
+
+        self.add_passthrough_option(
+                '--fixed-topology',
+                action='store_true',
+                dest='fixed_topology',
+                default=False,
+                help='Search for the tree of a locus once, under GTRIG, and score the other models on it'
+            )
+
+        self.add_passthrough_option(
+                '--genetree-backend',
+                dest='genetree_backend',
+                default='phyml',
+                type='choice',
+                choices=sorted(BACKENDS),
+                help='Program with which to select models and compute gene trees'
+            )
+
+        self.add_passthrough_option(
+                '--bootstrap-backend',
+                dest='bootstrap_backend',
+                default='phyml',
+                type='choice',
+                choices=sorted(BACKENDS),
+                help='Program with which to compute bootstrap trees.  FastTree is faster, but offers only GTR and JC models'
+            )
+
+        self.add_passthrough_option(
+                '--warm-start',
+                action='store_true',
+                dest='warm_start',
+                default=False,
+                help='Start the tree search of bootstrap replicates from the genetree of their locus'
+            )
+
+        self.add_passthrough_option(
+                '--fixed-parameters',
+                action='store_true',
+                dest='fixed_parameters',
+                default=False,
+                help='Fix the model parameters fitted to the genetree of a locus in its bootstrap replicates'
+            )
+
+        self.add_passthrough_option(
+                '--telemetry',
+                dest='telemetry',
+                default=None,
+                type='str',
+                help='Append the time, CPU and memory use of every program run to this file, on the node running it'
+            )
+
         self.add_passthrough_option(
                 '--gene-trees',
                 action="store_true",
@@ -65,6 +142,17 @@ class ProcessPhyloData(MRJob, Process):
             help="""Provide a constraint tree as quoted 
                     newick string. ex: --constraint-tree='((A,B),C);'""")
 
+    def load_options(self, args):
+        super(ProcessPhyloData, self).load_options(args)
+        if self.options.fixed_parameters and self.options.bootstrap_backend != 'phyml':
+            self.option_parser.error('--fixed-parameters requires the phyml bootstrap backend')
+        # the bundled FastTree is a Mach-O binary, so it cannot run on hadoop
+        # nodes, nor locally other than on a Mac
+        if 'fasttree' in [self.options.genetree_backend, self.options.bootstrap_backend] and \
+                (self.options.runner not in ['inline', 'local'] or platform.system() != 'Darwin'):
+            self.option_parser.error('The bundled FastTree only runs on Mac OS X; use the phyml backends, '
+                    'or cloudforest_mpi.py with --fasttree')
+
     def basic_reducer(self, key, line):
         """Do not reduce"""
         yield key, line
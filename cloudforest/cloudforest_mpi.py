@@ -15,10 +15,20 @@ directory of phylip files input on the CLI using MPI.
 import os
 import sys
 import glob
+import json
+import heapq
+import functools
+import itertools
 import argparse
+import traceback
 import numpy as np
-from time import localtime, strftime
-from core import Phyml, is_dir, is_file, FullPaths, phylip_to_oneliner, split_oneliner, oneliner_to_array, get_bootstraps, array_to_oneliner, oneliner_to_phylip
+from collections import OrderedDict
+from time import localtime, strftime, time
+from core import PhymlExecutor, get_backend, BACKENDS, DatasetReader, DatasetWriter, ResultCache, TelemetrySink, \
+        CostModel, read_telemetry, RunManifest, write_synced, \
+        is_dir, is_file, FullPaths, \
+        iter_phylip, get_bootstrap_occurrences, get_bootstrap_rng, get_bootstrap_seed, \
+        get_worker_scratch
 
 #import pdb
 
@@ -50,6 +60,25 @@ def get_args():
             action=FullPaths,
             help="""The path (including executable name) to PhyML on your platform.""",
         )
+    parser.add_argument(
+            "--fasttree",
+            action=FullPaths,
+            default=None,
+            help="""The path (including executable name) to FastTree on your platform.  Needed only with a fasttree backend.""",
+        )
+    parser.add_argument(
+            "--genetree-backend",
+            choices=sorted(BACKENDS),
+            default='phyml',
+            help="""The program with which to select models and compute genetrees.""",
+        )
+    parser.add_argument(
+            "--bootstrap-backend",
+            choices=sorted(BACKENDS),
+            default='phyml',
+            help="""The program with which to compute bootstrap trees.  FastTree is much faster than PhyML, but
+                only offers the GTR and JC models, with or without gamma rates.""",
+        )
     parser.add_argument(
             "--genetrees",
             action=FullPaths,
@@ -63,11 +92,60 @@ def get_args():
             default=100,
             help="""The number of bootstrap replicates to run.""",
         )
+    parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=1,
+            help="""The number of bootstrap replicates of a locus to analyse in one multi-dataset PhyML run.
+                Batching saves starting a PhyML process per replicate, which dominates for small loci.""",
+        )
+    parser.add_argument(
+            "--warm-start",
+            action="store_true",
+            default=False,
+            help="""Start the tree search of each bootstrap replicate from the genetree of its locus, rather than a BioNJ tree.""",
+        )
+    parser.add_argument(
+            "--fixed-parameters",
+            action="store_true",
+            default=False,
+            help="""Fix the substitution model parameters fitted to the genetree of each locus when computing its
+                bootstrap trees, so that only topology and branch lengths are optimised.""",
+        )
+    parser.add_argument(
+            "--parameters",
+            action=FullPaths,
+            type=is_file,
+            default=None,
+            help="""The path to the parameters.json output by a previous run.  Needed only with --fixed-parameters
+                when bootstrapping a prior run.""",
+        )
+    parser.add_argument(
+            "--seed",
+            type=int,
+            default=None,
+            help="""The seed for bootstrap resampling.  Any replicate of a run can be regenerated from its seed.""",
+        )
     parser.add_argument(
             "--parallelism",
-            choices=['mpi', 'multiprocessing', 'single'],
+            choices=['mpi', 'multiprocessing', 'single', 'subprocess'],
             default='mpi',
-            help="""The type of parallelism to use.""",
+            help="""The type of parallelism to use.  'mpi' needs mpi4py and is started with mpirun: rank 0
+                hands out tasks to the other ranks.  'subprocess' runs up to --cores PhyML processes
+                from this process, without python workers, and always runs all models.""",
+        )
+    parser.add_argument(
+            "--window",
+            type=int,
+            default=None,
+            help="""With --parallelism multiprocessing or mpi, the maximum number of chunks of tasks in flight.
+                Defaults to twice the number of workers.""",
+        )
+    parser.add_argument(
+            "--timeout",
+            type=int,
+            default=None,
+            help="""With --parallelism subprocess, the number of seconds after which a PhyML run is killed.""",
         )
     parser.add_argument(
             "--cores",
@@ -75,11 +153,74 @@ def get_args():
             default=7,
             help="""The number of compute cores to use.""",
         )
+    parser.add_argument(
+            "--model-threads",
+            type=int,
+            default=1,
+            help="""The number of substitution models to run concurrently when selecting the model of a locus.""",
+        )
+    parser.add_argument(
+            "--model-selection",
+            choices=['exhaustive', 'hierarchical'],
+            default='exhaustive',
+            help="""How to select the model of a locus.  'exhaustive' runs all 24 models; 'hierarchical' walks the nested models, skipping those that cannot have the best AICc.""",
+        )
+    parser.add_argument(
+            "--fixed-topology",
+            action="store_true",
+            default=False,
+            help="""During model selection, search for the tree of a locus once, under GTRIG, and score the other models on that tree.""",
+        )
+    parser.add_argument(
+            "--cache",
+            action=FullPaths,
+            default=None,
+            help="""The path to a directory in which to cache PhyML results.  Loci whose alignment, model and PhyML binary are unchanged are not recomputed.""",
+        )
+    parser.add_argument(
+            "--cache-size",
+            type=int,
+            default=None,
+            help="""The maximum size of the cache in MB.  Least recently used results are evicted beyond it.""",
+        )
+    parser.add_argument(
+            "--telemetry",
+            action=FullPaths,
+            default=None,
+            help="""The path to a file to which the time, CPU and memory use of every PhyML run is appended as JSON lines.
+                Summarize it with telemetry_report.py.""",
+        )
+    parser.add_argument(
+            "--resume",
+            action="store_true",
+            default=False,
+            help="""Resume a run that was killed, from the manifest in output.  Loci and replicates it completed
+                are not recomputed.""",
+        )
+    parser.add_argument(
+            "--scratch",
+            type=is_dir,
+            action=FullPaths,
+            default=None,
+            help="""The directory in which workers keep their temporary PhyML files, e.g. /dev/shm.  Defaults to the system temp dir.""",
+        )
 
     args = parser.parse_args()
 
     if args.run == 'bootstraps' and args.genetrees is None:
         sys.exit("\nIf runnning only boostraps, you must pass a genetrees file")
+    if 'fasttree' in [args.genetree_backend, args.bootstrap_backend] and args.fasttree is None:
+        sys.exit("\nA fasttree backend requires the path to FastTree (--fasttree)")
+    if args.fixed_parameters and args.run == 'bootstraps' and args.parameters is None:
+        sys.exit("\nFixing parameters of a prior run requires its parameters file (--parameters)")
+    if args.fixed_parameters and args.bootstrap_backend != 'phyml':
+        sys.exit("\nFixing parameters (--fixed-parameters) requires the phyml bootstrap backend")
+    if args.parallelism == 'subprocess' and (args.cache or args.model_selection != 'exhaustive' or
+            args.fixed_topology or args.model_threads > 1):
+        sys.exit("\n--parallelism subprocess runs every model of every locus as its own PhyML process, and does not "
+                "support --cache, --model-selection hierarchical, --fixed-topology or --model-threads")
+    if args.batch_size > 1 and (args.bootstrap_backend != 'phyml' or args.parallelism == 'subprocess'):
+        sys.exit("\nBatching (--batch-size) requires the phyml bootstrap backend and python workers")
 
     return args
 
@@ -93,17 +234,62 @@ def make_tree_name(args_dict):
     return name
 
 
-def generate_bootreps(bootreps, phyml, oneliners):
-    """Replicate the data set bootrep numer of times, prior to bootstrapping"""
-    # keep bootrep numbers indexed by one
-    for i in xrange(1, bootreps + 1):
-        yield i, phyml, oneliners
+def get_cache(args):
+    """Return the result cache given on the CLI, if any"""
+    if not args.cache:
+        return None
+    if args.cache_size:
+        return ResultCache(args.cache, args.cache_size * 2 ** 20)
+    return ResultCache(args.cache)
 
 
-def get_models_from_genetrees(genetrees):
-    """Iterate over a set of precomputed genetrees and return the models in metadata"""
-    # iterate over genetrees to grab models
-    models = {}
+def get_backend_path(args, backend):
+    """Return the path to the binary of a backend given on the CLI"""
+    if backend == 'fasttree':
+        return args.fasttree
+    return args.phyml
+
+
+def get_backend_options(args, backend, genetrees=True):
+    """Return the keyword arguments to a backend given on the CLI"""
+    options = {'cache': get_cache(args)}
+    if args.telemetry:
+        options['telemetry'] = TelemetrySink(args.telemetry)
+    if genetrees:
+        options['threads'] = args.model_threads
+        if backend == 'phyml':
+            options['model_selection'] = args.model_selection
+            options['fixed_topology'] = args.fixed_topology
+    return options
+
+
+def generate_bootreps(reps, backend, fullpth, store, seed, scratch=None, options=None, genetrees=None,
+        parameters=None):
+    """Replicate the data set for each of reps, prior to bootstrapping.
+    Only the path to the shared alignment store is replicated, not the data"""
+    # bootrep numbers are indexed by one
+    for i in reps:
+        yield i, backend, fullpth, store, seed, scratch, options or {}, genetrees, parameters
+
+
+def batch_bootreps(params, size):
+    """Group the parameters of consecutive bootreps into lists of size, so that
+    each worker has several replicates of every locus to batch.  Any
+    iterable is grouped lazily, e.g. batches into windows"""
+    batch = []
+    for param in params:
+        batch.append(param)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def read_genetrees(genetrees):
+    """Iterate over a set of precomputed genetrees and return the model in
+    metadata and the newick tree of each locus"""
+    loci = {}
     for line, tree in enumerate(open(genetrees, 'rU')):
         ts = tree.split(' ')[1].strip("'")
         for item in ts.split(','):
@@ -111,90 +297,671 @@ def get_models_from_genetrees(genetrees):
                 locus = item.split('=')[1]
             elif item.startswith('model'):
                 model = item.split('=')[1]
-        models[locus] = model
-    assert len(models) == line + 1, "Not all loci have a model"
-    return models
-
-
-def get_bootstrap_replicates(multilocus_bstrap):
-    """Boostrap the bases of all alignments in a resampled population of alignments"""
-    for locus in multilocus_bstrap:
-        # split keys from alignments
-        args_dict, locus = split_oneliner(locus)
-        # convert alignments to arrays
-        taxa, numpy_alignment = oneliner_to_array(locus.rstrip(';'))
-        # transpose so we bootstrap by columns
-        bases_by_col = np.column_stack(numpy_alignment)
-        # bootstrap by columns
-        shuffled = get_bootstraps(bases_by_col)
-        # transpose back to rows of sequences
-        shuffled = np.column_stack(shuffled)
-        # convert back to oneliner
-        oneliner = array_to_oneliner(taxa, shuffled)
-        oneliner = "%s:%s" % (make_tree_name(args_dict), oneliner)
-        yield oneliner
+        loci[locus] = (model, tree.split('[&U] ', 1)[1].strip())
+    assert len(loci) == line + 1, "Not all loci have a model"
+    return loci
+
+
+def get_models_from_genetrees(genetrees):
+    """Iterate over a set of precomputed genetrees and return the models in metadata"""
+    return dict([[locus, model] for locus, (model, tree) in read_genetrees(genetrees).iteritems()])
+
+
+# genetrees of each genetrees file, kept resident in a worker across tasks
+_starting_trees = {}
+
+
+def get_starting_trees(genetrees):
+    """Read the genetree of each locus, to start bootstrap searches from,
+    once per worker process"""
+    if genetrees not in _starting_trees:
+        loci = read_genetrees(genetrees)
+        _starting_trees[genetrees] = dict([[locus, tree] for locus, (model, tree) in loci.iteritems()])
+    return _starting_trees[genetrees]
+
+
+def write_parameters(args, genetrees):
+    """Write the model and fitted parameters of each locus, to fix them in
+    bootstraps"""
+    parameters = os.path.join(args.output, 'parameters.json')
+    with open(parameters, 'w') as outf:
+        json.dump(dict([[locus, {'model': model, 'parameters': fitted}]
+                for locus, model, tree, fitted in genetrees]), outf, indent=1, sort_keys=True)
+    return parameters
+
+
+# fitted parameters of each parameters file, kept resident in a worker across tasks
+_fixed_parameters = {}
+
+
+def get_fixed_parameters(parameters, locus, model):
+    """Return the parameters fitted to a locus under model, reading the
+    parameters file once per worker process.  Returns None for loci without
+    parameters, or whose parameters were fitted under another model"""
+    if not parameters:
+        return None
+    if parameters not in _fixed_parameters:
+        _fixed_parameters[parameters] = json.load(open(parameters))
+    fitted = _fixed_parameters[parameters].get(locus)
+    if fitted is None or fitted['model'] != model:
+        return None
+    return fitted['parameters']
+
+
+def write_alignment_store(args, models, alns):
+    """Write all loci, with their models, once to a memory-mappable dataset
+    that every worker reads in place"""
+    store = os.path.join(args.output, 'alignments.cfds')
+    with DatasetWriter(store) as writer:
+        for locus, phylip in sorted(alns.iteritems()):
+            writer.write(iter_phylip(phylip.split('\n'), locus, models[locus]).next())
+    return store
+
+
+# open (memory-mapped) reader of each store, kept in a worker across tasks
+_datasets = {}
+# site patterns of the loci last compressed by a worker, keyed by (store,
+# index), least recently used first
+_locus_patterns = OrderedDict()
+LOCUS_PATTERNS_CACHED = 8
+
+
+def get_dataset(store):
+    """Open a store once per worker process.  Loci are read in place from
+    the mapping, whose pages are shared by all workers"""
+    if store not in _datasets:
+        _datasets[store] = DatasetReader(store)
+    return _datasets[store]
+
+
+def get_locus_patterns(store, index):
+    """Compress the index-th locus of a store into its unique site patterns.
+    Only the LOCUS_PATTERNS_CACHED loci used last are kept, so that worker
+    memory does not grow with the number of loci, while tasks alternating
+    between a few loci do not compress them again each time"""
+    key = (store, index)
+    if key in _locus_patterns:
+        _locus_patterns[key] = _locus_patterns.pop(key)
+    else:
+        reader = get_dataset(store)
+        _locus_patterns[key] = reader[reader.index[index].name].site_patterns()
+        if len(_locus_patterns) > LOCUS_PATTERNS_CACHED:
+            _locus_patterns.popitem(last=False)
+    return _locus_patterns[key]
+
+
+def get_bootstrap_replicates(store, rep, seed=None):
+    """Boostrap across loci, then boostrap the bases of all alignments in the
+    resampled population of alignments.  Draws are addressed by (seed, rep)
+    and (seed, rep, locus), so any replicate can be regenerated on demand"""
+    # count how often each locus is drawn, so all draws of a locus are made
+    # in one call
+    occurrences = get_bootstrap_occurrences(len(get_dataset(store)), get_bootstrap_rng(seed, rep))
+    for index in np.flatnonzero(occurrences):
+        for args_dict, aln in get_locus_replicates(store, index, rep, occurrences[index], seed):
+            yield args_dict, aln
+
+
+def get_locus_replicates(store, index, rep, draws, seed=None):
+    """Yield the draws bootstrap replicates of the index-th locus of a store
+    in replicate rep"""
+    patterns = get_locus_patterns(store, index)
+    # run phyml w/ model from genetrees.  if no model, defaults to GTR
+    args_dict = {'chrm': patterns.name, 'model': patterns.model or 'GTR'}
+    rng = get_bootstrap_rng(seed, rep, patterns.name)
+    # bootstrap by reweighting patterns, then expand to full alignment
+    for weights in patterns.iter_bootstrap_weights(rng, draws):
+        yield args_dict.copy(), patterns.expand(weights)
+
+
+def get_bootstrap_slots(loci, rep, seed=None):
+    """Return the index of the locus resampled into each slot of a replicate,
+    in the order of get_bootstrap_replicates"""
+    occurrences = get_bootstrap_occurrences(loci, get_bootstrap_rng(seed, rep))
+    return np.repeat(np.arange(loci), occurrences)
+
+
+def get_bootstrap_slot(store, rep, slot, seed=None):
+    """Return the resampled alignment in one slot of a replicate, as
+    get_bootstrap_replicates would, without the rest of the replicate"""
+    slots = get_bootstrap_slots(len(get_dataset(store)), rep, seed)
+    index = slots[slot]
+    # the draws of a locus are made in one call; this is the nth of them.
+    # All its weights are drawn, to keep the stream of the rng, but only
+    # this one is expanded into an alignment
+    draw = slot - np.searchsorted(slots, index)
+    patterns = get_locus_patterns(store, index)
+    rng = get_bootstrap_rng(seed, rep, patterns.name)
+    weights = patterns.bootstrap_weights(rng, np.count_nonzero(slots == index))
+    return {'chrm': patterns.name, 'model': patterns.model or 'GTR'}, patterns.expand(weights[draw])
 
 
 def genetree_worker(params):
     """Worker function to compute genetrees for individual loci"""
-    locus, fullpth = params
+    locus, backend, fullpth, scratch, options = params
     name, phylip = locus
     pth, exe = os.path.split(fullpth)
     args_dict = {}
-    phyml = Phyml(phylip, pth=pth, exe=exe)
-    model, tree = phyml.best_aicc_model_and_tree()
+    with get_backend(backend)(phylip, pth=pth, exe=exe, scratch=get_worker_scratch(scratch), locus=name,
+            **options) as phyml:
+        model, tree = phyml.best_aicc_model_and_tree()
+        parameters = phyml.best_aicc_parameters()
     args_dict['chrm'] = name
     args_dict['model'] = model
     tree = "tree '%s' = [&U] %s" % (make_tree_name(args_dict), tree)
-    sys.stdout.write("[Info] {0} {1} genetree completed\n".format(
+    sys.stdout.write("[Info] {0} {1} genetree completed ({2} of {3} model runs saved)\n".format(
                 strftime("%a, %d %b %Y %H:%M:%S", localtime()),
-                name
+                name,
+                phyml.model_runs_saved,
+                len(phyml.models)
             )
         )
     sys.stdout.flush()
-    return (name, model, tree)
+    return (name, model, tree, parameters)
 
 
 def bootstrap_worker(params):
-    """Worker function to compute boostrap replicates of datasets and indiv. loci"""
-    bootstrap_trees = []
-    rep, fullpth, oneliners = params
+    """Worker function to compute the tree of one resampled locus slot of a
+    boostrap replicate.  Slots of all replicates are independent tasks, so
+    workers stay busy until the last locus; reduce_bootreps reassembles
+    the trees of each replicate"""
+    slot, rep, backend, fullpth, store, seed, scratch, options, genetrees, parameters = params
     pth, exe = os.path.split(fullpth)
-    # first, resample w/ replacement/bootstrap across loci
-    multilocus_bstrap = get_bootstraps(oneliners)
-    # Resample w/ replacement/boostrap bases within loci
-    bootstraps = get_bootstrap_replicates(multilocus_bstrap)
-    for oneliner in bootstraps:
-        args_dict, locus = split_oneliner(oneliner, default_model=True)
-        phylip = oneliner_to_phylip(locus)
-        phyml = Phyml(phylip, pth=pth, exe=exe)
-        # run phyml.  if no model, defaults to GTR
+    # warm start each replicate from the genetree of its locus
+    starting_trees = get_starting_trees(genetrees) if genetrees else {}
+    # resample w/ replacement/bootstrap across loci and bases within loci
+    args_dict, aln = get_bootstrap_slot(store, rep, slot, seed)
+    with get_backend(backend)(aln, pth=pth, exe=exe, scratch=get_worker_scratch(scratch), stage='bootstrap',
+            starting_tree=starting_trees.get(args_dict['chrm']),
+            parameters=get_fixed_parameters(parameters, args_dict['chrm'], args_dict['model']),
+            **options) as phyml:
+        # run the backend.  if no model, defaults to GTR
         # TOOD: Why do we need LnL?
         args_dict['lnL'], tree = phyml.run(args_dict['model'])
-        #bootstrap_trees.append("tree '%s' = [&U] %s" % (make_tree_name(args_dict), tree))
-        bootstrap_trees.append('''%s\t"%s"''' % (rep, tree))
-    sys.stdout.write("[Info] {0} bootstrap completed\n".format(
-            strftime("%a, %d %b %Y %H:%M:%S", localtime())
+    #bootstrap_trees.append("tree '%s' = [&U] %s" % (make_tree_name(args_dict), tree))
+    return rep, slot, '''%s\t"%s"''' % (rep, tree)
+
+
+def checkpoint_bootreps(results, manifest):
+    """Record each (rep, slot, tree) result of bootstrap_worker in the run
+    manifest as it completes, yielding (rep, slot, offset of the record) so
+    that trees need not be kept in memory"""
+    for rep, slot, tree in results:
+        yield rep, slot, manifest.write({'stage': 'bootstrap', 'rep': rep, 'slot': slot, 'tree': tree})
+
+
+def reduce_bootreps(results, loci, slots=None):
+    """Reassemble the (rep, slot, offset) results of checkpoint_bootreps into
+    replicates.  Yields (rep, offsets), in slot order, as soon as the loci
+    slots of a replicate have completed.  slots are the offsets of slots
+    completed earlier, keyed by (rep, slot)"""
+    bootreps = {}
+    for (rep, slot), offset in (slots or {}).iteritems():
+        bootreps.setdefault(rep, {})[slot] = offset
+    results = itertools.chain([(rep, None, None) for rep in sorted(bootreps)], results)
+    for rep, slot, offset in results:
+        if slot is not None:
+            bootreps.setdefault(rep, {})[slot] = offset
+        if len(bootreps.get(rep, ())) == loci:
+            offsets = bootreps.pop(rep)
+            yield rep, [offsets[slot] for slot in sorted(offsets)]
+
+
+def batched_bootstrap_worker(batch):
+    """Worker function to compute bootstrap trees of several replicates, running
+    the alignments of each locus in multi-dataset phyml runs of up to
+    len(batch) data sets rather than one phyml run each"""
+    reps = [params[0] for params in batch]
+    rep, backend, fullpth, store, seed, scratch, options, genetrees, parameters = batch[0]
+    pth, exe = os.path.split(fullpth)
+    starting_trees = get_starting_trees(genetrees) if genetrees else {}
+    # group the alignments of all replicates by locus and model, keeping the
+    # position of each in its replicate.  Loci are visited in turn, so each
+    # is compressed once for the whole batch
+    slots = dict([[rep, get_bootstrap_slots(len(get_dataset(store)), rep, seed)] for rep in reps])
+    loci = {}
+    for index in np.unique(np.concatenate(slots.values())):
+        for rep in reps:
+            first = np.searchsorted(slots[rep], index)
+            draws = np.count_nonzero(slots[rep] == index)
+            for position, (args_dict, aln) in enumerate(get_locus_replicates(store, index, rep, draws, seed), int(first)):
+                loci.setdefault((args_dict['chrm'], args_dict['model']), []).append((rep, position, aln))
+    bootstrap_trees = dict([[rep, []] for rep in reps])
+    for (locus, model), alns in sorted(loci.iteritems()):
+        for i in xrange(0, len(alns), len(batch)):
+            chunk = alns[i:i + len(batch)]
+            with get_backend(backend)([aln for rep, position, aln in chunk], pth=pth, exe=exe,
+                    scratch=get_worker_scratch(scratch), stage='bootstrap',
+                    starting_tree=starting_trees.get(locus),
+                    parameters=get_fixed_parameters(parameters, locus, model), **options) as phyml:
+                results = phyml.run_datasets(model)
+            for (rep, position, aln), (lnl, tree) in zip(chunk, results):
+                bootstrap_trees[rep].append((position, '%s\t"%s"' % (rep, tree)))
+    sys.stdout.write("[Info] {0} bootstraps {1}-{2} completed\n".format(
+            strftime("%a, %d %b %Y %H:%M:%S", localtime()),
+            reps[0],
+            reps[-1]
+        )
+    )
+    sys.stdout.flush()
+    # (rep, slot, tree) of each tree, as bootstrap_worker
+    return [(rep, position, tree) for rep in reps for position, tree in sorted(bootstrap_trees[rep])]
+
+
+def get_cost_model(args):
+    """Return a CostModel, calibrated by the telemetry file given on the CLI
+    if it exists from earlier runs"""
+    if args.telemetry and os.path.exists(args.telemetry):
+        return CostModel(read_telemetry(open(args.telemetry, 'rU')))
+    return CostModel()
+
+
+def get_workers(args):
+    """Return the number of workers tasks are spread over"""
+    if args.parallelism == 'single':
+        return 1
+    if args.parallelism == 'mpi':
+        from mpi4py import MPI
+        # every rank but the master
+        return MPI.COMM_WORLD.Get_size() - 1
+    return args.cores
+
+
+def get_genetree_costs(cost_model, alns):
+    """Estimate the cost of computing the genetree of each of alns, a list
+    of (name, phylip)"""
+    costs = []
+    for name, phylip in alns:
+        patterns = iter_phylip(phylip.split('\n'), name).next().site_patterns()
+        cost = cost_model.cost(patterns.ntax, patterns.npatterns, 'model selection', name)
+        costs.append(cost * cost_model.runs_per_locus('model selection'))
+    return costs
+
+
+def get_locus_costs(cost_model, store):
+    """Estimate the cost of a bootstrap run of each locus of a store"""
+    with DatasetReader(store) as reader:
+        # compressed one locus at a time, keeping only the counts
+        return np.array([cost_model.cost(aln.ntax, aln.site_patterns().npatterns, 'bootstrap', aln.name)
+                for aln in reader])
+
+
+def get_bootrep_costs(locus_costs, reps, seed):
+    """Estimate the cost of each of reps, from the loci it will draw and the
+    costs of get_locus_costs"""
+    return [float(np.dot(get_bootstrap_occurrences(len(locus_costs), get_bootstrap_rng(seed, rep)), locus_costs))
+            for rep in reps]
+
+
+def get_slot_costs(locus_costs, slots, seed):
+    """Estimate the cost of each of slots, as (rep, slot) in order of rep,
+    from the costs of get_locus_costs"""
+    slot_costs = []
+    last, loci = None, None
+    for rep, slot in slots:
+        if rep != last:
+            last, loci = rep, get_bootstrap_slots(len(locus_costs), rep, seed)
+        slot_costs.append(float(locus_costs[loci[slot]]))
+    return slot_costs
+
+
+# tasks per worker in each window of bootstrap tasks, which are ordered and
+# chunked a window at a time (see scheduled_imap)
+WINDOW_TASKS = 4
+
+
+def get_chunks(costs, workers):
+    """Order tasks longest first and group them into chunks, each of at least
+    half a worker's share of the remaining cost (guided self-scheduling).
+    The longest tasks are dispatched alone and first; the short tail is
+    batched, so that dispatch overhead stays low while the last chunks to
+    finish are small.  Returns lists of task indices"""
+    order = sorted(xrange(len(costs)), key=lambda index: costs[index], reverse=True)
+    remaining = float(sum(costs))
+    chunks = []
+    chunk, cost = [], 0.
+    for index in order:
+        chunk.append(index)
+        cost += costs[index]
+        if cost >= remaining / (2. * workers):
+            chunks.append(chunk)
+            remaining -= cost
+            chunk, cost = [], 0.
+    if chunk:
+        chunks.append(chunk)
+    return chunks
+
+
+def get_makespan(costs, workers):
+    """Return the makespan of running tasks of costs, in order, each on the
+    first worker to become free"""
+    loads = [0.] * min(workers, len(costs))
+    for cost in costs:
+        heapq.heapreplace(loads, loads[0] + cost)
+    return max(loads) if loads else 0.
+
+
+def chunk_worker(params):
+    """Worker function to run a chunk of tasks of another worker function"""
+    worker, chunk = params
+    return [worker(task) for task in chunk]
+
+
+def windowed_imap(submit, window, worker, tasks):
+    """Yield the results of worker over tasks as they complete, in any order.
+    Tasks are drawn from the iterable only as results come back, so that at
+    most window are in flight and memory does not grow with the number of
+    tasks.  submit(worker, task) starts a task and returns its AsyncResult,
+    as multiprocessing.Pool.apply_async"""
+    tasks = iter(tasks)
+    running = [submit(worker, task) for task in itertools.islice(tasks, window)]
+    while running:
+        ready = [result for result in running if result.ready()]
+        if not ready:
+            running[0].wait(0.1)
+            continue
+        for result in ready:
+            running.remove(result)
+            running.extend([submit(worker, task) for task in itertools.islice(tasks, 1)])
+            yield result.get()
+
+
+# tags of the messages between the mpi master and its workers
+TASK, RESULT, FAILURE, STOP = range(4)
+
+
+def mpi_worker(comm):
+    """Run the tasks sent by the mpi master until it sends STOP.  Workers
+    live for the whole run, so the alignment store, site patterns and
+    starting trees they load stay resident across tasks"""
+    from mpi4py import MPI
+    status = MPI.Status()
+    while True:
+        task = comm.recv(source=0, tag=MPI.ANY_TAG, status=status)
+        if status.Get_tag() == STOP:
+            break
+        worker, params = task
+        try:
+            result = worker(params)
+        except Exception:
+            comm.send(traceback.format_exc(), dest=0, tag=FAILURE)
+        else:
+            comm.send(result, dest=0, tag=RESULT)
+
+
+def mpi_imap(comm, window, worker, tasks):
+    """Yield the results of worker over tasks, run by the mpi workers, as
+    they complete, in any order.  Tasks are handed out on demand, to the
+    worker that returned a result.  Each worker holds up to window / workers
+    tasks, so that it starts its next task while the master gathers and
+    writes results"""
+    from mpi4py import MPI
+    ranks = range(1, comm.Get_size())
+    tasks = iter(tasks)
+    sends = []
+
+    def submit(rank):
+        for task in itertools.islice(tasks, 1):
+            sends.append(comm.isend((worker, task), dest=rank, tag=TASK))
+            return 1
+        return 0
+
+    running = 0
+    for i in xrange(max(1, window // len(ranks))):
+        for rank in ranks:
+            running += submit(rank)
+    status = MPI.Status()
+    while running:
+        result = comm.recv(source=MPI.ANY_SOURCE, tag=MPI.ANY_TAG, status=status)
+        running -= 1
+        if status.Get_tag() == FAILURE:
+            raise RuntimeError("mpi worker {0} failed:\n{1}".format(status.Get_source(), result))
+        running += submit(status.Get_source())
+        sends = [request for request in sends if not request.test()[0]]
+        yield result
+    MPI.Request.waitall(sends)
+
+
+def scheduled_imap(worker, windows, workers, name, calibrated=True):
+    """Map worker over windows of tasks in chunks, yielding the results of
+    each chunk, in any order, as it completes.  windows yields (get_task,
+    costs) for successive groups of tasks; each window is ordered longest
+    first and chunked on its own (see get_chunks), and is only made once the
+    previous one has been dispatched, so that memory and sorting stay bounded
+    by the window and the tasks of early windows are not held back behind
+    those of later ones.  get_task(index) returns a task, so tasks are only
+    made as they are dispatched.  Logs the predicted and actual makespan"""
+    # tasks, chunks and predicted makespan, summed over windows
+    totals = [0, 0, 0.]
+
+    def chunks():
+        for get_task, costs in windows:
+            window = get_chunks(costs, workers)
+            totals[0] += len(costs)
+            totals[1] += len(window)
+            totals[2] += get_makespan([sum([costs[index] for index in chunk]) for chunk in window], workers)
+            for chunk in window:
+                yield worker, [get_task(index) for index in chunk]
+
+    start = time()
+    for results in imap(chunk_worker, chunks()):
+        for result in results:
+            yield result
+    sys.stdout.write("[Info] {0} {1} tasks in {2} chunks on {3} workers: predicted makespan {4}, actual {5:.1f} s\n".format(
+            name,
+            totals[0],
+            totals[1],
+            workers,
+            "{0:.1f} s".format(totals[2]) if calibrated else "{0:.0f} units (no telemetry)".format(totals[2]),
+            time() - start
         )
     )
     sys.stdout.flush()
-    return bootstrap_trees
 
 
-def boostrap_all_loci(args, models, alns):
-    """Compute trees from bootstrap replicates of a dataset"""
-    oneliners = [phylip_to_oneliner(phylip, locus, models[locus]) \
-                for locus, phylip in alns.iteritems()]
+def check_failures(executor):
+    """Exit, listing them, if any runs of an executor failed"""
+    if executor.failures:
+        for locus, model, reason in executor.failures:
+            sys.stderr.write("[Error] {0} {1}: {2}\n".format(locus, model, reason))
+        sys.exit("\n{0} runs failed".format(len(executor.failures)))
+
+
+def executor_genetrees(args, alns):
+    """Compute genetrees for all loci with one PhymlExecutor, selecting the
+    model of each locus once all its models have completed.  Yields each
+    genetree as it completes"""
+    backend = get_backend(args.genetree_backend)
+    pth, exe = os.path.split(get_backend_path(args, args.genetree_backend))
+    scratch = get_worker_scratch(args.scratch)
+    options = get_backend_options(args, args.genetree_backend, genetrees=False)
+    phymls = dict([[name, backend(phylip, pth=pth, exe=exe, scratch=scratch, stage='model selection',
+            locus=name, telemetry=options.get('telemetry'))] for name, phylip in alns.iteritems()])
+    remaining = dict([[name, len(phyml.models)] for name, phyml in phymls.iteritems()])
+    # all models of a locus are queued together, so loci finish in turn,
+    # the costliest first
+    names = sorted(alns)
+    costs = dict(zip(names, get_genetree_costs(get_cost_model(args), [(name, alns[name]) for name in names])))
+    names.sort(key=lambda name: costs[name], reverse=True)
+    tasks = ((name, phymls[name], model) for name in names for model in phymls[name].models)
+    with PhymlExecutor(args.cores, args.timeout) as executor:
+        for result in executor.as_completed(tasks):
+            phyml = phymls[result.locus]
+            phyml.add_model_result(result.model, result.lnl, result.tree, result.parameters)
+            remaining[result.locus] -= 1
+            if remaining[result.locus] == 0:
+                model, tree = phyml.best_aicc_model_and_tree()
+                phyml.close()
+                args_dict = {'chrm': result.locus, 'model': model}
+                tree = "tree '%s' = [&U] %s" % (make_tree_name(args_dict), tree)
+                sys.stdout.write("[Info] {0} {1} genetree completed\n".format(
+                            strftime("%a, %d %b %Y %H:%M:%S", localtime()),
+                            result.locus
+                        )
+                    )
+                sys.stdout.flush()
+                yield result.locus, model, tree, phyml.best_aicc_parameters()
+    check_failures(executor)
+
+
+def executor_bootstraps(args, store, reps, slots, genetrees=None, parameters=None):
+    """Compute bootstrap trees for reps with one PhymlExecutor, skipping
+    slots already completed.  Replicates are generated only as processes
+    become free.  Yields (rep, slot, tree) as each completes"""
+    backend = get_backend(args.bootstrap_backend)
+    pth, exe = os.path.split(get_backend_path(args, args.bootstrap_backend))
+    scratch = get_worker_scratch(args.scratch)
+    telemetry = get_backend_options(args, args.bootstrap_backend, genetrees=False).get('telemetry')
+    starting_trees = get_starting_trees(genetrees) if genetrees else {}
+    phymls = {}
+
+    def tasks():
+        for rep in reps:
+            for index, (args_dict, aln) in enumerate(get_bootstrap_replicates(store, rep, args.seed)):
+                if (rep, index) in slots:
+                    continue
+                phymls[(rep, index)] = backend(aln, pth=pth, exe=exe, scratch=scratch, stage='bootstrap',
+                        telemetry=telemetry, starting_tree=starting_trees.get(args_dict['chrm']),
+                        parameters=get_fixed_parameters(parameters, args_dict['chrm'], args_dict['model']))
+                yield (rep, index), phymls[(rep, index)], args_dict['model']
+
+    with PhymlExecutor(args.cores, args.timeout) as executor:
+        for result in executor.as_completed(tasks()):
+            phymls.pop(result.locus).close()
+            rep, index = result.locus
+            yield rep, index, '%s\t"%s"' % (rep, result.tree)
+    check_failures(executor)
+
+
+def genetrees_all_loci(args, alns, manifest):
+    """Compute the genetree of each locus, appending it to genetrees.tre and
+    the run manifest as it completes.  Loci completed in the manifest are
+    not recomputed"""
+    genetrees = [(record['locus'], record['model'], record['tree'], record['parameters'])
+            for record in manifest.get('genetree')]
+    completed = set([genetree[0] for genetree in genetrees])
+    alns = dict([[name, phylip] for name, phylip in alns.iteritems() if name not in completed])
+    if completed:
+        sys.stdout.write("[Info] resuming with {0} genetrees completed\n".format(len(completed)))
+    # rewrite the genetrees of the manifest, which may be behind the file
+    outf = open(os.path.join(args.output, 'genetrees.tre'), 'w')
+    write_synced(outf, ''.join(["%s\n" % (genetree[2]) for genetree in genetrees]))
+    if args.parallelism == 'subprocess':
+        results = executor_genetrees(args, alns)
+    else:
+        # replicate our options for passing to map()
+        backend = args.genetree_backend
+        opts = (backend, get_backend_path(args, backend), args.scratch, get_backend_options(args, backend))
+        params = [(aln,) + opts for aln in alns.items()]
+        cost_model = get_cost_model(args)
+        costs = get_genetree_costs(cost_model, alns.items())
+        results = scheduled_imap(genetree_worker, [(params.__getitem__, costs)], get_workers(args), 'genetrees',
+                cost_model.calibrated)
+    for name, model, tree, parameters in results:
+        write_synced(outf, "%s\n" % (tree))
+        manifest.write({'stage': 'genetree', 'locus': name, 'model': model, 'tree': tree,
+                'parameters': parameters})
+        genetrees.append((name, model, tree, parameters))
+    outf.close()
+    write_parameters(args, genetrees)
+    return genetrees
+
+
+def get_seed(args, manifest):
+    """Return the bootstrap seed of a run, recording it in the manifest so
+    that resumed runs draw the same replicates"""
+    seeds = [record['seed'] for record in manifest.get('seed')]
+    if seeds:
+        if args.seed is not None and args.seed != seeds[0]:
+            sys.exit("\nThe run being resumed has seed {0}, not {1}".format(seeds[0], args.seed))
+        return seeds[0]
+    seed = get_bootstrap_seed() if args.seed is None else args.seed
+    manifest.write({'stage': 'seed', 'seed': seed})
+    return seed
+
+
+def boostrap_all_loci(args, models, alns, manifest, genetrees=None, parameters=None):
+    """Compute trees from bootstrap replicates of a dataset, appending each
+    replicate to N-bootreps.tree and each tree to the run manifest as it
+    completes.  Replicates and slots completed in the manifest are not
+    recomputed.  With a genetrees file and --warm-start, replicates start
+    from the genetree of their locus.  With a parameters file and
+    --fixed-parameters, they keep the parameters fitted to it"""
+    if not args.warm_start:
+        genetrees = None
+    if not args.fixed_parameters:
+        parameters = None
+    # write the data once; workers map it rather than receive a copy per rep
+    store = write_alignment_store(args, models, alns)
     # for every rep in boostraps, map loci onto worker that will
     # bootstrap, run phyml, and return bootstrap trees
-    params = generate_bootreps(args.bootreps, args.phyml, oneliners)
-    bootreps = mmap(bootstrap_worker, params)
-    # write
+    args.seed = get_seed(args, manifest)
+    sys.stdout.write("[Info] bootstrap seed {0}\n".format(args.seed))
+    completed = set([record['rep'] for record in manifest.get('bootreps')])
+    slots = dict([[(record['rep'], record['slot']), offset] for offset, record in manifest.locate('bootstrap')])
+    # rewrite the replicates of the manifest, which may be behind the file
     outname = "%s-bootreps.tree" % (args.bootreps)
     outf = open(os.path.join(args.output, outname), 'w')
-    for bootrep in bootreps:
-        for tree in bootrep:
-            outf.write("%s\n" % (tree))
+    for rep, offsets in reduce_bootreps([], len(alns), dict([[key, offset] for key, offset in slots.iteritems()
+            if key[0] in completed])):
+        write_synced(outf, ''.join(["%s\n" % (manifest.read(offset)['tree']) for offset in offsets]))
+    slots = dict([[key, offset] for key, offset in slots.iteritems() if key[0] not in completed])
+    reps = [rep for rep in xrange(1, args.bootreps + 1) if rep not in completed]
+    if completed:
+        sys.stdout.write("[Info] resuming with {0} bootstraps completed\n".format(len(completed)))
+    if args.parallelism == 'subprocess':
+        results = executor_bootstraps(args, store, reps, slots, genetrees, parameters)
+    else:
+        cost_model = get_cost_model(args)
+        locus_costs = get_locus_costs(cost_model, store)
+        workers = get_workers(args)
+        if args.batch_size > 1:
+            # batches rerun replicates of which only some slots completed
+            counts = {}
+            for rep, slot in slots:
+                counts[rep] = counts.get(rep, 0) + 1
+            reps = [rep for rep in reps if counts.get(rep, 0) < len(alns)]
+            rerun = set(reps)
+            slots = dict([[key, offset] for key, offset in slots.iteritems() if key[0] not in rerun])
+        params = generate_bootreps(reps, args.bootstrap_backend, get_backend_path(args, args.bootstrap_backend),
+                store, args.seed, args.scratch, get_backend_options(args, args.bootstrap_backend, genetrees=False),
+                genetrees, parameters)
+        if args.batch_size > 1:
+            # a window of a few batches per worker at a time
+            def windows():
+                for window in batch_bootreps(batch_bootreps(params, args.batch_size), WINDOW_TASKS * workers):
+                    costs = get_bootrep_costs(locus_costs, [param[0] for batch in window for param in batch],
+                            args.seed)
+                    costs = [sum(costs[i:i + args.batch_size]) for i in xrange(0, len(costs), args.batch_size)]
+                    yield window.__getitem__, costs
+
+            results = itertools.chain.from_iterable(scheduled_imap(batched_bootstrap_worker, windows(),
+                    workers, 'bootstraps', cost_model.calibrated))
+        else:
+            # one task per (replicate, locus slot), so the last task to finish
+            # is one locus rather than a whole replicate.  Tasks are listed
+            # and ordered a window of replicates at a time, enough for a few
+            # slots per worker, so that memory is bounded by the window
+            # rather than growing with replicates x loci, and replicates
+            # complete, and are written, as the run goes
+            def windows():
+                for window in batch_bootreps(params, -(-WINDOW_TASKS * workers // len(alns))):
+                    tasks = [(slot,) + param for param in window for slot in xrange(len(alns))
+                            if (param[0], slot) not in slots]
+                    yield tasks.__getitem__, get_slot_costs(locus_costs, [(task[1], task[0]) for task in tasks],
+                            args.seed)
+
+            results = scheduled_imap(bootstrap_worker, windows(), workers, 'bootstraps', cost_model.calibrated)
+    for rep, offsets in reduce_bootreps(checkpoint_bootreps(results, manifest), len(alns), slots):
+        write_synced(outf, ''.join(["%s\n" % (manifest.read(offset)['tree']) for offset in offsets]))
+        manifest.write({'stage': 'bootreps', 'rep': rep})
+        sys.stdout.write("[Info] {0} bootstrap {1} completed\n".format(
+                strftime("%a, %d %b %Y %H:%M:%S", localtime()),
+                rep
+            )
+        )
+        sys.stdout.flush()
+    outf.close()
 
 
 def main():
@@ -203,43 +970,65 @@ def main():
     alns = {}
     for f in glob.glob(os.path.join(args.input, '*.phy*')):
         alns[os.path.splitext(os.path.basename(f))[0]] = open(f, 'rU').read()
-    # replicate our options for passing to map()
-    opts = [args.phyml for i in range(len(alns))]
+    # the record of completed work, to --resume from
+    manifest = RunManifest(os.path.join(args.output, 'manifest.jsonl'), args.resume)
+    runs = manifest.get('run')
+    if not runs:
+        manifest.write({'stage': 'run', 'run': args.run, 'bootreps': args.bootreps})
+    elif (runs[0]['run'], runs[0]['bootreps']) != (args.run, args.bootreps):
+        sys.exit("\nThe run being resumed is '{0}' with {1} bootreps".format(runs[0]['run'], runs[0]['bootreps']))
     # compute genetrees
     if args.run == 'genetrees' or args.run == 'both':
         sys.stdout.write("Running genetrees...\n\n")
-        params = zip(alns.items(), opts)
-        genetrees = mmap(genetree_worker, params)
-        # write genetrees to output file
-        outf = open(os.path.join(args.output, 'genetrees.tre'), 'w')
-        for tree in genetrees:
-            outf.write("%s\n" % (tree[2]))
-        outf.close()
+        genetrees = genetrees_all_loci(args, alns, manifest)
     # compute bootreps on genetrees from above
     if args.run == 'both':
         sys.stdout.write("Running bootstraps of genetrees...\n")
         # get models for each locus based on genetrees in-memory
         models = dict([[tree[0], tree[1]] for tree in genetrees])
-        boostrap_all_loci(args, models, alns)
+        boostrap_all_loci(args, models, alns, manifest, os.path.join(args.output, 'genetrees.tre'),
+                os.path.join(args.output, 'parameters.json'))
     # compute bootreps on genetrees from a file
     if args.run == 'bootstraps':
         sys.stdout.write("Running boostraps...\n")
         # get models for each locus based on genetrees in genetree file
         models = get_models_from_genetrees(args.genetrees)
-        boostrap_all_loci(args, models, alns)
+        boostrap_all_loci(args, models, alns, manifest, args.genetrees, args.parameters)
+    manifest.close()
 
 
 if __name__ == '__main__':
     args = get_args()
     if args.parallelism == 'mpi':
-        from deap.dtm import map as mmap
-        from deap.dtm import start
-        start(main)
+        from mpi4py import MPI
+        comm = MPI.COMM_WORLD
+        if comm.Get_size() < 2:
+            sys.exit("\n--parallelism mpi needs a master and at least one worker, e.g. mpirun -np 4")
+        if comm.Get_rank() == 0:
+            imap = functools.partial(mpi_imap, comm, args.window or 2 * get_workers(args))
+            try:
+                main()
+            except SystemExit as error:
+                # workers wait on the master; take them down with it
+                sys.stderr.write("%s\n" % (error.code))
+                comm.Abort(1)
+            except Exception:
+                traceback.print_exc()
+                comm.Abort(1)
+            for rank in xrange(1, comm.Get_size()):
+                comm.send(None, dest=rank, tag=STOP)
+        else:
+            mpi_worker(comm)
     elif args.parallelism == 'multiprocessing':
         from multiprocessing import Pool
         pool = Pool(args.cores)
-        mmap = pool.map
+        # tasks are already chunked by scheduled_imap
+        imap = functools.partial(windowed_imap, lambda worker, task: pool.apply_async(worker, (task,)),
+                args.window or 2 * args.cores)
         main()
-    elif args.parallelism == 'single':
-        mmap = map
+        # let workers exit cleanly, removing their scratch dirs
+        pool.close()
+        pool.join()
+    elif args.parallelism == 'single' or args.parallelism == 'subprocess':
+        imap = itertools.imap
         main()
@@ -14,12 +14,22 @@ Description: Core functions for cloudforest
 import os
 import re
 import sys
+import mmap
+import struct
+import urllib
 import shutil
+import json
+import time
+import hashlib
 import argparse
 import platform
 import tempfile
 import subprocess
 import numpy as np
+from collections import namedtuple
+from multiprocessing.pool import ThreadPool
+from multiprocessing import cpu_count
+from multiprocessing.util import Finalize
 
 #import pdb
 
@@ -49,31 +59,85 @@ def format_oneliner_from_dict(taxa_seq_dict, name, model=None):
         return "chrm=%s,model=%s:%s;" % (name.strip(), model, ','.join(seq))
 
 
-def phylip_to_oneliner(phylip, locus, model=None):
-    taxa_id_dict, taxa_seq_dict = {}, {}
-    count = 0
-    for lineno, line in enumerate(phylip.split('\n')):
+def _is_phylip_header(words):
+    """[Private] Return True if split line is a phylip header of ntax nchar"""
+    return len(words) == 2 and words[0].isdigit() and words[1].isdigit()
+
+
+def iter_phylip(fin, name=None, model=None, interleaved=True, strict=False):
+    """Lazily parse one or more concatenated PHYLIP alignments from fin, an
+    iterable of lines (e.g. an open file), in a single pass.
+
+    Bases are written into a preallocated (ntax, nchar) uint8 matrix as they
+    are read, rather than appended to per-taxon strings.  Taxon names and
+    sequence are separated by whitespace (relaxed PHYLIP), except that a
+    name line of one word longer than 10 characters is read as a strict
+    PHYLIP name of 10 characters touching its sequence.  If strict is True,
+    names are always the first 10 columns, and may contain spaces.  A
+    sequence longer than nchar raises ValueError.  Interleaved blocks are assigned
+    to taxa in turn; if interleaved is False, a taxon's sequence continues
+    on following lines until nchar bases have been read.  As before, an
+    alignment shorter than its header is accepted if all taxa are of equal
+    length when the next header or the end of fin is reached.
+
+    Yields Alignment
+
+    """
+    def finish():
+        length = filled[0]
+        if len(taxa) != taxa_count or (filled != length).any():
+            raise ValueError("Alignment ended before all %s taxa had %s characters" % (taxa_count, align_len))
+        return Alignment(taxa, bases[:, :length], name, model)
+
+    bases = None
+    for line in fin:
+        words = line.split()
         # skip blank lines
-        if len(line.strip()) == 0:
+        if not words:
+            continue
+        # IDENTIFY START OF ALIGNMENT
+        if _is_phylip_header(words) and (bases is None or not len(taxa) < taxa_count):
+            if bases is not None:
+                yield finish()
+            taxa_count, align_len = int(words[0]), int(words[1])
+            bases = np.empty((taxa_count, align_len), dtype=np.uint8)
+            filled = np.zeros(taxa_count, dtype=np.int64)
+            taxa, row = [], -1
             continue
-        if lineno == 0:
-            taxa_count, align_len = [int(i) for i in line.strip().split()]
-        # INITIALIZE DICTS WITH TAXA ID'S AND INITIAL SEQS
-        if 0 < count <= taxa_count:
-            # clean up errant spaces
-            sp = [val for val in line.split(' ') if val != '']
-            name = sp[0]
-            sequence = ''.join(sp[1:])
-            taxa_id_dict[count] = name
-            taxa_seq_dict[name] = sequence.replace(' ', '')
-        # ADD ADDITIONAL LINES TO ALIGNMENT
-        if count > taxa_count:
-            num = count % taxa_count
-            if num == 0:
-                num = max(taxa_id_dict.keys())
-            name = taxa_id_dict[num]
-            taxa_seq_dict[name] += line.strip().replace(' ', '')
-        count += 1
+        if bases is None:
+            raise ValueError("Expected a phylip header, found: %s" % line.strip())
+        # choose the taxon this line belongs to
+        if len(taxa) < taxa_count and (interleaved or row < 0 or filled[row] == align_len):
+            # INITIALIZE TAXA ID'S AND INITIAL SEQS
+            row = len(taxa)
+            if strict or (len(words) == 1 and len(words[0]) > 10):
+                taxa.append(line[:10].strip())
+                sequence = ''.join(line[10:].split())
+            else:
+                taxa.append(words[0])
+                sequence = ''.join(words[1:])
+        else:
+            # ADD ADDITIONAL LINES TO ALIGNMENT
+            if interleaved:
+                row = (row + 1) % taxa_count
+            sequence = ''.join(words)
+        start = filled[row]
+        if start + len(sequence) > align_len:
+            raise ValueError("Sequence of %s is longer than %s" % (taxa[row], align_len))
+        bases[row, start:start + len(sequence)] = np.frombuffer(sequence, dtype=np.uint8)
+        filled[row] += len(sequence)
+        # yield complete alignments and look for another header
+        if len(taxa) == taxa_count and (filled == align_len).all():
+            yield finish()
+            bases = None
+    if bases is not None:
+        yield finish()
+
+
+def phylip_to_oneliner(phylip, locus, model=None):
+    aln = iter_phylip(phylip.split('\n')).next()
+    # formatting from a dict keeps the taxon order of existing oneliners
+    taxa_seq_dict = dict(zip(aln.taxa, aln.sequences()))
     oneliner = format_oneliner_from_dict(taxa_seq_dict, locus, model)
     return oneliner
 
@@ -129,8 +193,92 @@ def get_bootstraps(sample, replicates=1, return_choices=False):
             return sample[choices].tolist(), choices
 
     else:
-        return [sample[rng.randint(0, size, size)].tolist()
-                        for i in xrange(replicates)]
+        # draw all replicates in one call, then index in one call
+        return sample[get_bootstrap_matrix(size, replicates, rng)].tolist()
+
+
+def get_bootstrap_rng(seed=None, *keys):
+    """Return a random number generator addressed by (seed, keys), where keys
+    are typically the replicate number and locus name.
+
+    The generator state is derived by hashing the address rather than by
+    advancing a shared stream, so the same (seed, replicate, locus) always
+    gives the same resample on any worker or node, in any order.  If seed is
+    None, the generator is seeded from /dev/urandom and is not reproducible.
+
+    Returns numpy.random.RandomState
+
+    """
+    if seed is None:
+        return np.random.RandomState()
+    address = ':'.join([str(key) for key in (seed,) + keys])
+    digest = hashlib.sha256(address).digest()
+    return np.random.RandomState(np.frombuffer(digest, dtype=np.uint32))
+
+
+def get_bootstrap_seed():
+    """Draw a new run seed from /dev/urandom"""
+    return int(np.random.RandomState().randint(0, 2 ** 31 - 1))
+
+
+# upper bound on the number of elements in a chunk of bootstrap replicates
+# (2 ** 22 int64 values is 32 MB)
+BOOTSTRAP_CHUNK_ELEMENTS = 2 ** 22
+
+
+def get_bootstrap_matrix(size, replicates=1, rng=None):
+    """Draw the column indices of many bootstrap replicates at once.
+
+    Returns array of shape (replicates, size)
+
+    """
+    if rng is None:
+        # Create generator w/ seed.  None as input draws from /dev/urandom
+        rng = np.random.RandomState()
+    return rng.randint(0, size, (replicates, size))
+
+
+def get_bootstrap_weights(counts, replicates=1, rng=None):
+    """Draw many bootstrap replicates at once as weights over site patterns
+    (or any other classes) occuring counts times.
+
+    Returns array of shape (replicates, len(counts))
+
+    """
+    if rng is None:
+        # Create generator w/ seed.  None as input draws from /dev/urandom
+        rng = np.random.RandomState()
+    counts = np.asarray(counts)
+    size = counts.sum()
+    return rng.multinomial(size, counts / float(size), size=replicates)
+
+
+def get_bootstrap_occurrences(size, rng=None):
+    """Bootstrap size items (e.g. loci) and return the number of times each
+    item was drawn, rather than a list of the draws.
+
+    Returns array of shape (size,)
+
+    """
+    if rng is None:
+        # Create generator w/ seed.  None as input draws from /dev/urandom
+        rng = np.random.RandomState()
+    return np.bincount(rng.randint(0, size, size), minlength=size)
+
+
+def iter_bootstrap_weights(counts, replicates, chunk_size=None, rng=None):
+    """Stream the pattern weights of replicates in chunks of at most
+    chunk_size rows, so that all replicates never need to be in memory.
+    The chunks hold the same draws as get_bootstrap_weights(counts,
+    replicates, rng).
+
+    Yields arrays of shape (<= chunk_size, len(counts))
+
+    """
+    if chunk_size is None:
+        chunk_size = max(1, BOOTSTRAP_CHUNK_ELEMENTS // max(1, len(counts)))
+    for start in xrange(0, replicates, chunk_size):
+        yield get_bootstrap_weights(counts, min(chunk_size, replicates - start), rng)
 
 
 def oneliner_to_array(line):
@@ -139,13 +287,9 @@ def oneliner_to_array(line):
     Returns tuple(list, array)
 
     """
-    seqs = line.split(",")
-    label_seqs = zip(seqs[:-1:2], seqs[1::2])
-    taxa, bases = [], []
-    for taxon, seq in label_seqs:
-        bases.append(list(seq))
-        taxa.append(taxon.strip())
-    return taxa, np.array(bases)
+    aln = Alignment.from_oneliner(line)
+    # view the uint8 matrix as single characters - no copy is made
+    return aln.taxa, aln.bases.view('S1')
 
 
 def array_to_oneliner(taxa, bases):
@@ -192,6 +336,312 @@ def split_oneliner(line, args_dict=None, default_model=False):
     return args_dict, locus
 
 
+class Alignment(object):
+    """An alignment held as a contiguous (ntax, nchar) matrix of uint8
+    character codes, along with taxon labels and optional locus metadata"""
+    def __init__(self, taxa, bases, name=None, model=None):
+        bases = np.asarray(bases)
+        if bases.dtype != np.uint8:
+            # views of single characters (e.g. 'S1') share the same bytes
+            bases = bases.view(np.uint8) if bases.dtype.itemsize == 1 else bases.astype(np.uint8)
+        if bases.ndim != 2 or bases.shape[0] != len(taxa):
+            raise ValueError("Alignment must have one row of bases per taxon")
+        self.taxa = list(taxa)
+        self.bases = np.ascontiguousarray(bases)
+        self.name = name
+        self.model = model
+
+    def __str__(self):
+        return "Alignment of %s taxa and %s characters" % (self.ntax, self.nchar)
+
+    def __repr__(self):
+        return "<Alignment %s (%s x %s) at %s>" % (self.name, self.ntax, self.nchar, hex(id(self)))
+
+    @property
+    def ntax(self):
+        return self.bases.shape[0]
+
+    @property
+    def nchar(self):
+        return self.bases.shape[1]
+
+    @classmethod
+    def from_sequences(cls, taxa, seqs, name=None, model=None):
+        """Create an alignment from parallel lists of taxa and sequence strings"""
+        if len(seqs) == 0:
+            raise ValueError("Alignment has no content")
+        nchar = len(seqs[0])
+        if any(len(seq) != nchar for seq in seqs):
+            raise ValueError("Sequences in an alignment must be of equal length")
+        # a single join, then the matrix is a view onto those bytes
+        bases = np.frombuffer(''.join(seqs), dtype=np.uint8).reshape(len(seqs), nchar)
+        return cls(taxa, bases, name, model)
+
+    @classmethod
+    def from_oneliner(cls, line):
+        """Create an alignment from a oneliner, with or without locus metadata"""
+        args_dict, locus = split_oneliner(line.strip().rstrip(';'))
+        seqs = locus.split(',')
+        taxa = [taxon.strip() for taxon in seqs[:-1:2]]
+        return cls.from_sequences(taxa, seqs[1::2], args_dict.get('chrm'), args_dict.get('model'))
+
+    def sequences(self):
+        """Return list of sequence strings, in taxon order"""
+        return [row.tostring() for row in self.bases]
+
+    def take(self, columns):
+        """Return a new alignment composed of the given column indices"""
+        return Alignment(self.taxa, self.bases.take(columns, axis=1), self.name, self.model)
+
+    def site_patterns(self):
+        """Return the unique site patterns of the alignment with their counts"""
+        return SitePatterns.from_alignment(self)
+
+    def to_oneliner(self, args_dict=None):
+        """Convert alignment to oneliner, prefixed by args_dict metadata if given"""
+        oneliner = ','.join(['%s,%s' % (taxon, seq) for taxon, seq in zip(self.taxa, self.sequences())])
+        if args_dict:
+            oneliner = "%s:%s" % (make_tree_name(args_dict), oneliner)
+        return oneliner
+
+    def to_phylip(self):
+        """Convert alignment to phylip format, identical to oneliner_to_phylip"""
+        # pad all names to length of longest name + 1 space
+        max_name_length = max([len(taxon) for taxon in self.taxa]) + 1
+        header = "%s %s\n" % (self.ntax, self.nchar)
+        alignment = '\n'.join(['%s%s' % (taxon.ljust(max_name_length), seq) \
+                for taxon, seq in zip(self.taxa, self.sequences())])
+        return header + alignment
+
+
+class SitePatterns(object):
+    """The unique columns (site patterns) of an alignment and the number of
+    times each occurs.  Bootstrap replicates are weight vectors over the
+    patterns and are only expanded to full alignments when needed."""
+    def __init__(self, taxa, patterns, counts, name=None, model=None):
+        self.taxa = list(taxa)
+        self.patterns = np.ascontiguousarray(patterns, dtype=np.uint8)
+        self.counts = np.asarray(counts, dtype=np.int64)
+        self.name = name
+        self.model = model
+
+    def __repr__(self):
+        return "<SitePatterns %s (%s patterns of %s sites) at %s>" % (self.name, self.npatterns, self.nchar, hex(id(self)))
+
+    @property
+    def ntax(self):
+        return self.patterns.shape[0]
+
+    @property
+    def npatterns(self):
+        return self.patterns.shape[1]
+
+    @property
+    def nchar(self):
+        return int(self.counts.sum())
+
+    @classmethod
+    def from_alignment(cls, aln):
+        """Compress an alignment into its unique site patterns"""
+        # view every column as a single opaque value so np.unique can
+        # compare whole columns at once
+        columns = np.ascontiguousarray(aln.bases.T)
+        columns = columns.view(np.dtype((np.void, aln.ntax))).ravel()
+        unique, index, inverse = np.unique(columns, return_index=True, return_inverse=True)
+        counts = np.bincount(inverse, minlength=len(unique))
+        return cls(aln.taxa, aln.bases[:, index], counts, aln.name, aln.model)
+
+    def bootstrap_weights(self, rng=None, replicates=None):
+        """Return a bootstrap replicate as a vector of pattern weights, or a
+        (replicates, npatterns) matrix of them if replicates is given.
+
+        Resampling nchar columns with replacement is equivalent to drawing
+        pattern weights from a multinomial with probabilities counts/nchar.
+
+        """
+        if replicates is None:
+            return get_bootstrap_weights(self.counts, 1, rng)[0]
+        return get_bootstrap_weights(self.counts, replicates, rng)
+
+    def iter_bootstrap_weights(self, rng=None, replicates=1, chunk_size=None):
+        """Yield the rows of bootstrap_weights(rng, replicates) one at a time,
+        drawn in chunks (see iter_bootstrap_weights)"""
+        for chunk in iter_bootstrap_weights(self.counts, replicates, chunk_size, rng):
+            for weights in chunk:
+                yield weights
+
+    def expand(self, weights=None):
+        """Expand the patterns, repeated by weights, into a full Alignment"""
+        if weights is None:
+            weights = self.counts
+        return Alignment(self.taxa, np.repeat(self.patterns, weights, axis=1), self.name, self.model)
+
+
+class DatasetIndexEntry(namedtuple('DatasetIndexEntry', 'name model offset ntax nchar')):
+    """Location and shape of one locus in a binary dataset file"""
+    __slots__ = ()
+
+
+class DatasetWriter(object):
+    """Write alignments to an indexed binary dataset file.
+
+    File layout (little-endian):
+
+        header  magic 'CFDS', version (H), reserved (H), nloci (I), index offset (Q)
+        loci    per locus: ntax length-prefixed (H) taxon labels, then the
+                ntax * nchar uint8 matrix of bases
+        index   per locus: length-prefixed (H) name and model, then the
+                offset of the locus (Q), ntax (I) and nchar (I)
+
+    The index is written on close(), so loci can be streamed in one pass.
+
+    """
+    magic = 'CFDS'
+    version = 1
+    header = struct.Struct('<4sHHIQ')
+    entry = struct.Struct('<QII')
+
+    def __init__(self, path):
+        self.path = path
+        self.index = []
+        self._names = set()
+        self._fout = open(path, 'wb')
+        # placeholder header, rewritten on close
+        self._fout.write(self.header.pack(self.magic, self.version, 0, 0, 0))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def write(self, aln, name=None, model=None):
+        """Append an Alignment, named by name or aln.name"""
+        name = name or aln.name
+        model = model or aln.model or ''
+        if not name:
+            raise ValueError("Loci in a dataset must be named")
+        if name in self._names:
+            raise ValueError("Locus %s is already in the dataset" % name)
+        offset = self._fout.tell()
+        self._fout.write(''.join([self._pack_string(taxon) for taxon in aln.taxa]))
+        self._fout.write(aln.bases.tostring())
+        self.index.append(DatasetIndexEntry(name, model, offset, aln.ntax, aln.nchar))
+        self._names.add(name)
+
+    def close(self):
+        """Write the index and header, and close the file"""
+        if self._fout.closed:
+            return
+        index_offset = self._fout.tell()
+        for entry in self.index:
+            self._fout.write(self._pack_string(entry.name))
+            self._fout.write(self._pack_string(entry.model))
+            self._fout.write(self.entry.pack(entry.offset, entry.ntax, entry.nchar))
+        self._fout.seek(0)
+        self._fout.write(self.header.pack(self.magic, self.version, 0, len(self.index), index_offset))
+        self._fout.close()
+
+    def _pack_string(self, string):
+        """[Private] Length-prefix a string"""
+        return struct.pack('<H', len(string)) + string
+
+
+class DatasetReader(object):
+    """Random access, by locus name, to an indexed binary dataset file.
+
+    The file is memory-mapped, so alignments returned are read-only views
+    onto the page cache, shared by every process reading the same file.
+
+    """
+    def __init__(self, path):
+        self.path = path
+        self._fin = open(path, 'rb')
+        try:
+            self._mmap = mmap.mmap(self._fin.fileno(), 0, access=mmap.ACCESS_READ)
+        except:
+            self._fin.close()
+            raise
+        magic, version, reserved, nloci, index_offset = \
+                DatasetWriter.header.unpack_from(self._mmap, 0)
+        if magic != DatasetWriter.magic:
+            self.close()
+            raise IOError("%s is not a cloudforest dataset" % path)
+        if version != DatasetWriter.version:
+            self.close()
+            raise IOError("%s is dataset version %s, expected %s" % (path, version, DatasetWriter.version))
+        self.index = self._read_index(index_offset, nloci)
+        self._lookup = dict([[entry.name, entry] for entry in self.index])
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def __len__(self):
+        return len(self.index)
+
+    def __contains__(self, name):
+        return name in self._lookup
+
+    def __iter__(self):
+        for entry in self.index:
+            yield self._read_locus(entry)
+
+    def __getitem__(self, name):
+        return self._read_locus(self._lookup[name])
+
+    def names(self):
+        """Return locus names, in file order"""
+        return [entry.name for entry in self.index]
+
+    def get(self, name):
+        """Return the Alignment for a locus"""
+        return self[name]
+
+    def close(self):
+        """Close the file.  The mapping itself is released once no Alignment
+        read from it is still referenced, so those stay valid."""
+        self._mmap = None
+        self._fin.close()
+
+    def _unpack_string(self, offset):
+        """[Private] Read a length-prefixed string, returning it and the next offset"""
+        length, = struct.unpack_from('<H', self._mmap, offset)
+        offset += 2
+        return self._mmap[offset:offset + length], offset + length
+
+    def _read_index(self, offset, nloci):
+        """[Private] Read the index at the end of the file"""
+        index = []
+        for i in xrange(nloci):
+            name, offset = self._unpack_string(offset)
+            model, offset = self._unpack_string(offset)
+            locus_offset, ntax, nchar = DatasetWriter.entry.unpack_from(self._mmap, offset)
+            offset += DatasetWriter.entry.size
+            index.append(DatasetIndexEntry(name, model, locus_offset, ntax, nchar))
+        return index
+
+    def _read_locus(self, entry):
+        """[Private] Read taxa and map the bases of a locus"""
+        taxa, offset = [], entry.offset
+        for i in xrange(entry.ntax):
+            taxon, offset = self._unpack_string(offset)
+            taxa.append(taxon)
+        bases = np.frombuffer(self._mmap, dtype=np.uint8,
+                count=entry.ntax * entry.nchar, offset=offset)
+        return Alignment(taxa, bases.reshape(entry.ntax, entry.nchar), entry.name, entry.model or None)
+
+
+def write_dataset(path, alignments):
+    """Write an iterable of named Alignments to a binary dataset file"""
+    with DatasetWriter(path) as writer:
+        for aln in alignments:
+            writer.write(aln)
+    return path
+
+
 class FullPaths(argparse.Action):
     """Expand user- and relative-paths"""
     def __call__(self, parser, namespace, values, option_string=None):
@@ -206,24 +656,26 @@ class Process():
     def get_bootstrap_replicates(self, key, line):
         loci = line.strip().split(';')
         loci = loci[:-1]
-        # first, bootstrap across loci
-        multilocus_bstrap = get_bootstraps(loci)
-        # second, bootstrap bases within loci
-        for locus in multilocus_bstrap:
+        # key is the replicate number from duplicate_oneliner.  with a seed,
+        # any replicate can be regenerated exactly when a task is retried
+        try:
+            seed = self.options.seed
+        except AttributeError:
+            seed = None
+        # first, bootstrap across loci, counting how often each is drawn
+        occurrences = get_bootstrap_occurrences(len(loci), get_bootstrap_rng(seed, key))
+        # second, bootstrap bases within loci - every draw of a locus in
+        # one call.  Loci that were not drawn are never parsed.
+        for index in np.flatnonzero(occurrences):
             # split keys from alignments
-            args_dict, locus = split_oneliner(locus)
-            # convert alignments to arrays
-            taxa, numpy_alignment = oneliner_to_array(locus)
-            # transpose so we bootstrap by columns
-            bases_by_col = np.column_stack(numpy_alignment)
-            # bootstrap by columns
-            shuffled = get_bootstraps(bases_by_col)
-            # transpose back to rows of sequences
-            shuffled = np.column_stack(shuffled)
-            # convert back to oneliner
-            oneliner = array_to_oneliner(taxa, shuffled)
-            oneliner = "%s:%s" % (make_tree_name(args_dict), oneliner)
-            yield key, oneliner
+            args_dict, locus = split_oneliner(loci[index])
+            # compress alignments into unique site patterns
+            patterns = Alignment.from_oneliner(locus).site_patterns()
+            rng = get_bootstrap_rng(seed, key, args_dict.get('chrm', index))
+            # bootstrap by reweighting patterns, then expand to full alignment
+            for weights in patterns.iter_bootstrap_weights(rng, occurrences[index]):
+                # convert back to oneliner
+                yield key, patterns.expand(weights).to_oneliner(args_dict)
 
     def process_stats_file(self, fin):
         """"given an input phyml stats file, return the log-likelihood of the tree"""
@@ -237,6 +689,28 @@ class Process():
             raise ValueError("No Log-likelihood found")
         return float(result.groups()[0])
 
+    def _get_backend(self, bootstraps=False):
+        """[Private] Return the inference backend chosen for genetrees or
+        bootstraps, PhyML by default"""
+        try:
+            if bootstraps:
+                name = self.options.bootstrap_backend
+            else:
+                name = self.options.genetree_backend
+        except AttributeError:
+            name = 'phyml'
+        return get_backend(name)
+
+    def _get_telemetry(self):
+        """[Private] Return the TelemetrySink given by --telemetry, if any"""
+        try:
+            path = self.options.telemetry
+        except AttributeError:
+            path = None
+        if path:
+            return TelemetrySink(path)
+        return None
+
     def get_genetrees(self, key, line, pth='bin', genetrees=True, no_model=False):
         """Compute genetrees using model in oneliner. Parses out evolutionary
          model if provided as first word in file.  Otherwise, runs GTR."""
@@ -247,13 +721,28 @@ class Process():
         if len(line.split("\t")) == 2:
             key, line = line.split("\t")
         args_dict, locus = split_oneliner(line, default_model=True)
+        # the genetree of the locus, when carried along to warm start from
+        starting_tree = args_dict.pop('tree', None)
+        if starting_tree:
+            starting_tree = urllib.unquote(starting_tree)
+        # and the parameters fitted to it, when carried along to fix them
+        parameters = args_dict.pop('parameters', None)
+        if parameters:
+            parameters = json.loads(urllib.unquote(parameters))
 
         phylip = oneliner_to_phylip(locus)
-        phyml = Phyml(phylip, pth)
-        # run phyml.  if no model, defaults to GTR
-        # TOOD: Why do we need LnL?
-        #   For comparing the quality of topologies
-        args_dict['lnL'], tree = phyml.run(args_dict['model'])
+        # in a full analysis, the trees computed here are bootstrap trees
+        try:
+            bootstraps = self.options.full_analysis
+        except AttributeError:
+            bootstraps = False
+        with self._get_backend(bootstraps)(phylip, pth, stage='bootstrap' if bootstraps else 'genetree',
+                locus=args_dict.get('chrm'), starting_tree=starting_tree, parameters=parameters,
+                telemetry=self._get_telemetry()) as phyml:
+            # run phyml.  if no model, defaults to GTR
+            # TOOD: Why do we need LnL?
+            #   For comparing the quality of topologies
+            args_dict['lnL'], tree = phyml.run(args_dict['model'])
         try:
             gtrees = self.options.gene_trees
             no_model = self.options.mraic_opt
@@ -271,17 +760,43 @@ class Process():
         oneliner = line.split("\t")[-1].strip('\n')
         args_dict, locus = split_oneliner(line)
         phylip = oneliner_to_phylip(locus)
-        phyml = Phyml(phylip, pth)
-        model, tree = phyml.best_aicc_model_and_tree()
+        try:
+            threads = self.options.model_threads
+            model_selection = self.options.model_selection
+            fixed_topology = self.options.fixed_topology
+        except AttributeError:
+            threads = 1
+            model_selection = 'exhaustive'
+            fixed_topology = False
+        backend = self._get_backend()
+        options = {'threads': threads}
+        if backend.name == 'phyml':
+            options['model_selection'] = model_selection
+            options['fixed_topology'] = fixed_topology
+        with backend(phylip, pth, locus=args_dict.get('chrm'), telemetry=self._get_telemetry(),
+                **options) as phyml:
+            model, tree = phyml.best_aicc_model_and_tree()
+            parameters = phyml.best_aicc_parameters()
         args_dict['model'] = model
-        oneliner = "%s:%s" % (make_tree_name(args_dict), oneliner.split(":")[-1])
         try:
             gtrees = self.options.gene_trees
+            warm_start = self.options.warm_start
+            fixed_parameters = self.options.fixed_parameters
         except AttributeError:
             gtrees = genetrees
+            warm_start = False
+            fixed_parameters = False
         if gtrees == True:
             yield key, "tree '%s' = [&U] %s" % (make_tree_name(args_dict), tree)
         else:
+            if warm_start:
+                # carry the genetree along with the alignment, quoted to
+                # survive oneliner parsing, to start bootstraps from
+                args_dict['tree'] = urllib.quote(tree, safe='')
+            if fixed_parameters:
+                # likewise the fitted parameters, to fix in bootstraps
+                args_dict['parameters'] = urllib.quote(json.dumps(parameters), safe='')
+            oneliner = "%s:%s" % (make_tree_name(args_dict), oneliner.split(":")[-1])
             yield 1, oneliner
 
     def duplicate_oneliner(self, key, line, bootreps=500):
@@ -302,31 +817,384 @@ class Process():
         yield 1, concatenated_line
 
 
-class Phyml:
-    """Use phyml to generate trees or help select models"""
+# checksums of phyml binaries, by (path, size, mtime)
+_binary_checksums = {}
+
+
+def get_binary_checksum(path):
+    """Return the sha1 of a binary, computed once per process and version"""
+    stat = os.stat(path)
+    key = (path, stat.st_size, stat.st_mtime)
+    if key not in _binary_checksums:
+        sha = hashlib.sha1()
+        with open(path, 'rb') as fin:
+            for block in iter(lambda: fin.read(2 ** 20), ''):
+                sha.update(block)
+        _binary_checksums[key] = sha.hexdigest()
+    return _binary_checksums[key]
+
+
+def wait_rusage(process, block=True):
+    """Wait for a subprocess.Popen process with os.wait4, returning the
+    resource usage of the process alone, or None if block is False and it
+    is still running.  Sets process.returncode as Popen.wait() does."""
+    pid, status, rusage = os.wait4(process.pid, 0 if block else os.WNOHANG)
+    if pid == 0:
+        return None
+    process._handle_exitstatus(status)
+    return rusage
+
+
+class TelemetrySink(object):
+    """Append one JSON record per line to a file.  Records are written with
+    a single append each, so processes can share a sink."""
+    def __init__(self, path):
+        self.path = os.path.abspath(os.path.expanduser(path))
+
+    def __repr__(self):
+        return "<TelemetrySink at %s>" % (self.path)
+
+    def write(self, record):
+        """Append a record, which must be serializable as JSON"""
+        with open(self.path, 'a') as fout:
+            fout.write(json.dumps(record, sort_keys=True) + '\n')
+
+
+def read_telemetry(fin):
+    """Yield the records of a telemetry file"""
+    for line in fin:
+        if line.strip():
+            yield json.loads(line)
+
+
+def write_synced(fout, text):
+    """Write text to an open file and force it to disk"""
+    fout.write(text)
+    fout.flush()
+    os.fsync(fout.fileno())
+
+
+class RunManifest(object):
+    """Journal of the completed tasks of a run, one JSON record per line.
+    Each record is forced to disk before the next task is accounted for, so
+    a run killed at any point can be resumed from its manifest.  Resuming
+    keeps the records of the manifest, dropping a last record cut short by
+    the kill; otherwise the manifest is started afresh.  Records are read
+    back from the file rather than kept in memory."""
+    def __init__(self, path, resume=False):
+        self.path = os.path.abspath(os.path.expanduser(path))
+        if resume and os.path.exists(self.path):
+            self.fout = open(self.path, 'r+b')
+            # truncate to whole records, so appends start on a new line
+            self.fout.truncate(self._get_length())
+        else:
+            self.fout = open(self.path, 'wb')
+        self.fin = open(self.path, 'rb')
+
+    def __repr__(self):
+        return "<RunManifest at %s>" % (self.path)
+
+    def _get_length(self):
+        """[Private] Return the length of the whole records of the file"""
+        length = 0
+        for line in self.fout:
+            try:
+                json.loads(line)
+            except ValueError:
+                break
+            if not line.endswith('\n'):
+                break
+            length += len(line)
+        return length
+
+    def close(self):
+        self.fout.close()
+        self.fin.close()
+
+    def write(self, record):
+        """Append a record, which must be serializable as JSON, and return
+        its offset"""
+        self.fout.seek(0, os.SEEK_END)
+        offset = self.fout.tell()
+        write_synced(self.fout, json.dumps(record, sort_keys=True) + '\n')
+        return offset
+
+    def read(self, offset):
+        """Return the record at offset"""
+        self.fin.seek(offset)
+        return json.loads(self.fin.readline())
+
+    def locate(self, stage):
+        """Yield the (offset, record) of each record of a stage"""
+        with open(self.path, 'rb') as fin:
+            offset = 0
+            for line in fin:
+                record = json.loads(line)
+                if record.get('stage') == stage:
+                    yield offset, record
+                offset += len(line)
+
+    def get(self, stage):
+        """Return the records of a stage"""
+        return [record for offset, record in self.locate(stage)]
+
+
+class CostModel(object):
+    """Estimate the run time of a locus from its size, as ntax * site patterns,
+    calibrated by telemetry records (see TelemetrySink).  The seconds per unit
+    are fit per stage; loci in the telemetry are further scaled by how much
+    slower or faster than predicted they ran.  Without telemetry, costs are
+    in units rather than seconds."""
+    def __init__(self, records=()):
+        self.units = {}
+        self.wall = {}
+        self.runs = {}
+        self.loci = {}
+        for record in records:
+            # older records have no patterns; nchar bounds them
+            units = self.get_units(record['ntax'], record.get('patterns') or record['nchar'])
+            for key in [record.get('stage'), (record.get('locus'), record.get('stage'))]:
+                self.units[key] = self.units.get(key, 0.) + units
+                self.wall[key] = self.wall.get(key, 0.) + record['wall']
+            self.runs[record.get('stage')] = self.runs.get(record.get('stage'), 0) + 1
+            self.loci.setdefault(record.get('stage'), set()).add(record.get('locus'))
+
+    def __repr__(self):
+        return "<CostModel of %s stages>" % len([key for key in self.units if not isinstance(key, tuple)])
+
+    @property
+    def calibrated(self):
+        """True if costs are in seconds"""
+        return bool(self.units)
+
+    def get_units(self, ntax, patterns):
+        """Return the work units of an alignment: the likelihood of every site
+        pattern is computed at every node"""
+        return float(ntax * patterns)
+
+    def rate(self, stage):
+        """Return the seconds per unit of a stage, or of all stages if the
+        stage has no records, or 1 without telemetry"""
+        if self.units.get(stage):
+            return self.wall[stage] / self.units[stage]
+        total = sum([units for key, units in self.units.iteritems() if not isinstance(key, tuple)])
+        if total:
+            return sum([wall for key, wall in self.wall.iteritems() if not isinstance(key, tuple)]) / total
+        return 1.
+
+    def runs_per_locus(self, stage):
+        """Return the mean number of runs of a stage per locus, e.g. of the
+        models run to select the model of a locus"""
+        if not self.runs.get(stage):
+            return 1.
+        return float(self.runs[stage]) / len(self.loci[stage])
+
+    def cost(self, ntax, patterns, stage=None, locus=None):
+        """Return the estimated cost of one run of an alignment"""
+        rate = self.rate(stage)
+        cost = rate * self.get_units(ntax, patterns)
+        key = (locus, stage)
+        if locus is not None and self.units.get(key) and self.units.get(stage):
+            # how much slower or faster than predicted this locus ran
+            cost *= (self.wall[key] / self.units[key]) / rate
+        return cost
+
+
+class ResultCache(object):
+    """An on-disk cache of phyml results, one JSON file per key.  Keys are
+    content hashes, so entries never go stale; when max_size (in bytes) is
+    given, the least recently used entries are evicted to stay below it.
+    Several processes may share one cache directory.  Each keeps a running
+    total of the cache size, and only lists the directory once it exceeds
+    max_size."""
+    def __init__(self, path, max_size=None):
+        self.path = os.path.abspath(os.path.expanduser(path))
+        self.max_size = max_size
+        if not os.path.isdir(self.path):
+            try:
+                os.makedirs(self.path)
+            except OSError:
+                # another worker created it first
+                if not os.path.isdir(self.path):
+                    raise
+        self.size = None
+        if max_size is not None:
+            self.size = sum([size for mtime, size, name in self._get_entries()])
+
+    def __repr__(self):
+        return "<ResultCache at %s>" % (self.path)
+
+    def key(self, *parts):
+        """Hash the parts of a key"""
+        sha = hashlib.sha1()
+        for part in parts:
+            sha.update(part)
+            sha.update('\0')
+        return sha.hexdigest()
+
+    def _entry(self, key):
+        """[Private] Return the path of an entry"""
+        return os.path.join(self.path, "%s.json" % key)
+
+    def get(self, key):
+        """Return the value stored for key, or None"""
+        entry = self._entry(key)
+        try:
+            with open(entry, 'rb') as fin:
+                value = json.load(fin)
+        except (IOError, ValueError):
+            return None
+        # mark as recently used
+        try:
+            os.utime(entry, None)
+        except OSError:
+            pass
+        return value
+
+    def put(self, key, value):
+        """Store value, which must be serializable as JSON, under key"""
+        fd, temp = tempfile.mkstemp(dir=self.path, suffix='.tmp')
+        with os.fdopen(fd, 'wb') as fout:
+            json.dump(value, fout)
+        if self.max_size is not None:
+            try:
+                # an entry being replaced no longer counts
+                replaced = os.path.getsize(self._entry(key))
+            except OSError:
+                replaced = 0
+        # rename is atomic, so readers never see a partial entry
+        os.rename(temp, self._entry(key))
+        if self.max_size is not None:
+            if self.size is None:
+                self.size = sum([size for mtime, size, name in self._get_entries()])
+            else:
+                self.size += os.path.getsize(self._entry(key)) - replaced
+            if self.size > self.max_size:
+                self.evict()
+
+    def _get_entries(self):
+        """[Private] Return the (mtime, size, name) of each entry"""
+        entries = []
+        for name in os.listdir(self.path):
+            if not name.endswith('.json'):
+                continue
+            try:
+                stat = os.stat(os.path.join(self.path, name))
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, name))
+        return entries
+
+    def evict(self):
+        """Remove least recently used entries until below max_size"""
+        entries = self._get_entries()
+        total = sum([size for mtime, size, name in entries])
+        for mtime, size, name in sorted(entries):
+            if total <= self.max_size:
+                break
+            try:
+                os.remove(os.path.join(self.path, name))
+            except OSError:
+                # evicted by another worker
+                pass
+            total -= size
+        # entries added by other processes are counted again here
+        self.size = total
+
+
+# reusable scratch dirs of this process, by (pid, root)
+_worker_scratch = {}
+
+
+def get_worker_scratch(root=None):
+    """Return a scratch dir under root (e.g. /dev/shm) for Phyml instances
+    of this process to share, created on first use and removed when the
+    process exits.  Each instance removes its own files on close()."""
+    key = (os.getpid(), root)
+    if key not in _worker_scratch:
+        scratch = tempfile.mkdtemp(prefix='cloudforest-', dir=root)
+        # multiprocessing runs finalizers at exit, in pool workers too
+        Finalize(None, shutil.rmtree, args=(scratch,), kwargs={'ignore_errors': True}, exitpriority=0)
+        _worker_scratch[key] = scratch
+    return _worker_scratch[key]
+
+
+class InferenceBackend(object):
+    """Base class of the programs that infer trees.  Subclasses start the
+    program for a model with _launch_model() and read its lnl and tree with
+    _parse_outputs(); working files, telemetry, caching and model selection
+    by AICc are shared."""
+    # name of the backend on the CLI
+    name = None
+    # binary in pth to use when no exe is given, by platform.system()
+    binaries = {}
+    default_binary = None
+
     def __init__(self, phylip, pth='bin', temp_dir=None, exe=None,
-                       starting_tree=None, constraint_tree=None):
-        self.cwd = os.getcwd()
-        if not temp_dir:
-            working = tempfile.mkdtemp()
+                       starting_tree=None, constraint_tree=None, threads=1, cache=None,
+                       scratch=None, telemetry=None, stage=None, locus=None):
+        # fail before writing anything if there is no binary to run
+        self.binary = self._get_binary_pth(pth, exe)
+        # number of models run concurrently during model selection
+        self.threads = threads
+        # optional TelemetrySink, and the stage (e.g. genetree, bootstrap)
+        # and locus recorded for each run
+        self.telemetry = telemetry
+        self.stage = stage
+        self.locus = locus
+        # optional ResultCache consulted before running the program
+        self.cache = cache
+        # number of alignments in the input, see run_datasets()
+        self.datasets = 1
+        # files we create, removed by close() when working in a shared scratch dir
+        self._files = set()
+        if scratch:
+            # work in an existing, reusable dir (see get_worker_scratch)
+            self.working = os.path.abspath(scratch)
+            self._owns_working = False
         else:
-            # generate a tempdir in which we'll work
-            working = tempfile.mkdtemp(dir=temp_dir)
-        self.working = os.path.abspath(working)
+            if not temp_dir:
+                working = tempfile.mkdtemp()
+            else:
+                # generate a tempdir in which we'll work
+                working = tempfile.mkdtemp(dir=temp_dir)
+            self.working = os.path.abspath(working)
+            self._owns_working = True
+        # if we get an Alignment, write it to tempdir/tempfile
+        if isinstance(phylip, Alignment):
+            if self.locus is None:
+                self.locus = phylip.name
+            self.phylip = self._string_2_tempfile(string=phylip.to_phylip(), suffix='phylip')
+        # if we get several Alignments (e.g. bootstrap replicates of a
+        # locus), write them to one multi-dataset file
+        elif isinstance(phylip, (list, tuple)) and phylip and isinstance(phylip[0], Alignment):
+            if self.locus is None:
+                self.locus = phylip[0].name
+            self.datasets = len(phylip)
+            string = '\n'.join([aln.to_phylip() for aln in phylip]) + '\n'
+            self.phylip = self._string_2_tempfile(string=string, suffix='phylip')
         # if we get a file for phylip var, put in tempdir
-        if os.path.exists(phylip):
+        elif os.path.exists(phylip):
             phylip = os.path.abspath(os.path.expanduser(phylip))
-            self.phylip = os.path.join(self.working, os.path.basename(phylip))
+            if self.locus is None:
+                self.locus = os.path.splitext(os.path.basename(phylip))[0]
+            if self._owns_working:
+                self.phylip = os.path.join(self.working, os.path.basename(phylip))
+            else:
+                # other instances may be working on the same file in scratch
+                self.phylip = self._string_2_tempfile(string='', suffix=os.path.basename(phylip))
             shutil.copyfile(
                     phylip,
                     self.phylip
                     )
+            self._files.add(self.phylip)
         # if we get a string for a file, write to tempdir/tempfile
         elif type(phylip) == str:
             self.phylip = self._string_2_tempfile(string=phylip, suffix='phylip')
         else:
-            raise TypeError("Input must be a phylip file or a phylip-formatted string")
+            raise TypeError("Input must be a phylip file, a phylip-formatted string, an Alignment or a list of Alignments")
 
+        self.starting_tree = None
         if starting_tree != None:
            self.starting_tree = self._string_2_tempfile(string=starting_tree, suffix='txt')
 
@@ -336,99 +1204,74 @@ class Phyml:
         if constraint_tree != None:
            self.constraint_tree = self._string_2_tempfile(string=constraint_tree, suffix='txt')
 
-
-        self.phyml3 = self._get_phyml_pth(pth, exe)
         # container for model selection results
         self.aicc_results = None
-        # model parameters taken from John Nylander's excellent mr_aic.pl
-        # http://www.abc.se/~nylander/
-        self.models = {
-                'JC69': "+\nM\nM\nM\nM\nM\nR\nY\n",
-                'JC69I': "+\nM\nM\nM\nM\nM\nV\nY\nR\nY\n",
-                'JC69G': "+\nM\nM\nM\nM\nM\nY\n",
-                'JC69IG': "+\nM\nM\nM\nM\nM\nV\nY\nY\n",
-                'F81': "+\nM\nM\nM\nM\nM\nM\nM\nF\nR\nY\n",
-                'F81I': "+\nM\nM\nM\nM\nM\nM\nM\nF\nV\nY\nR\nY\n",
-                'F81G': "+\nM\nM\nM\nM\nM\nM\nM\nF\nY\n",
-                'F81IG': "+\nM\nM\nM\nM\nM\nM\nM\nF\nV\nY\nY\n",
-                'K2P': "+\nM\nM\nM\nM\nM\nM\nT\nY\nR\nY\n",
-                'K2PI': "+\nM\nM\nM\nM\nM\nM\nT\nY\nR\nV\nY\nY\n",
-                'K2PG': "+\nM\nM\nM\nM\nM\nM\nT\nY\nY\n",
-                'K2PIG': "+\nM\nM\nM\nM\nM\nM\nT\nY\nV\nY\nY\n",
-                'HKY': "+\nF\nT\nY\nR\nY\n",
-                'HKYI': "+\nF\nT\nY\nR\nV\nY\nY\n",
-                'HKYG': "+\nF\nT\nY\nY\n",
-                'HKYIG': "+\nF\nT\nY\nV\nY\nY\n",
-                'SYM': "+\nM\nM\nM\nM\nE\n0.25\n0.25\n0.25\n0.25\nK\n012345\n1.00\n1.00\n1.00\n1.00\n1.00\n1.00\nR\nY\n",
-                'SYMI': "+\nM\nM\nM\nM\nE\n0.25\n0.25\n0.25\n0.25\nK\n012345\n1.00\n1.00\n1.00\n1.00\n1.00\n1.00\nR\nV\nY\nY\n",
-                'SYMG': "+\nM\nM\nM\nM\nE\n0.25\n0.25\n0.25\n0.25\nK\n012345\n1.00\n1.00\n1.00\n1.00\n1.00\n1.00\nY\n",
-                'SYMIG': "+\nM\nM\nM\nM\nE\n0.25\n0.25\n0.25\n0.25\nK\n012345\n1.00\n1.00\n1.00\n1.00\n1.00\n1.00\nV\nY\nY\n",
-                'GTR': "+\nM\nM\nM\nF\nR\nY\n",
-                'GTRI': "+\nM\nM\nM\nF\nR\nV\nY\nY\n",
-                'GTRG': "+\nM\nM\nM\nF\nY\n",
-                'GTRIG': "+\nM\nM\nM\nF\nV\nY\nY\n"
-            }
-        self.numparams = {
-                'JC69': 0,
-                'JC69I': 1,
-                'JC69G': 1,
-                'JC69IG': 2,
-                'F81': 3,
-                'F81I': 4,
-                'F81G': 4,
-                'F81IG': 5,
-                'K2P': 1,
-                'K2PI': 2,
-                'K2PG': 2,
-                'K2PIG': 3,
-                'HKY': 4,
-                'HKYI': 5,
-                'HKYG': 5,
-                'HKYIG': 6,
-                'SYM': 5,
-                'SYMI': 6,
-                'SYMG': 6,
-                'SYMIG': 7,
-                'GTR': 8,
-                'GTRI': 9,
-                'GTRG': 9,
-                'GTRIG': 10
-            }
-        # compile regex for LnL once
-        self.ll = re.compile("Log-likelihood:\s+(.+)")
         self.dim = re.compile("\s*(\d+)\s+(\d+)")
 
     def __del__(self):
-        """Cleanup empty dir - not guaranteed to be called during execution,
-        only at close"""
-        shutil.rmtree(self.working)
+        """Cleanup - not guaranteed to be called during execution, so prefer
+        close() or using the backend as a context manager"""
+        self.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        """Remove the working dir, or only our files from a shared scratch dir.
+        Safe to call more than once."""
+        if not hasattr(self, '_owns_working'):
+            # __init__ did not get far enough to create anything
+            return
+        if self._owns_working:
+            shutil.rmtree(self.working, ignore_errors=True)
+        else:
+            for f in self._files:
+                try:
+                    os.remove(f)
+                except OSError:
+                    pass
+        self._files = set()
 
     def __str__(self):
-        return "Phyml object of %s" % os.path.basename(self.phylip)
+        return "%s object of %s" % (self.__class__.__name__, os.path.basename(self.phylip))
 
     def __repr__(self):
-        return "<Phyml object of %s at %s>" % (os.path.basename(self.phylip), hex(id(self)))
+        return "<%s object of %s at %s>" % (self.__class__.__name__, os.path.basename(self.phylip), hex(id(self)))
 
     def _string_2_tempfile(self,string,suffix):
         """[Private] Create tempfile with data from string."""
         fd, file_path = tempfile.mkstemp(dir=self.working, suffix=suffix, text=True)
         os.write(fd, string)
         os.close(fd)
+        self._files.add(file_path)
         return file_path
 
-    def _get_phyml_pth(self, pth, exe):
-        """[Private] Get path to phyml"""
+    def _get_binary_pth(self, pth, exe):
+        """[Private] Get path to the binary"""
         if not exe:
             # USE CORRECT BINARYS
-            if platform.system() == 'Darwin':
-                #system = 'OSX_setup'
-                phyml3 = os.path.join(pth, 'PhyML3OSX')
-            else:
-                #system = 'AWS_setup'
-                phyml3 = os.path.join(pth, 'PhyML3linux32')
-        else:
-            phyml3 = os.path.join(pth, exe)
-        return os.path.abspath(os.path.expanduser(phyml3))
+            exe = self.binaries.get(platform.system(), self.default_binary)
+            if not exe:
+                raise ValueError("No %s binary is bundled for %s; give the path to one (exe)" % (
+                        self.name, platform.system()))
+        return os.path.abspath(os.path.expanduser(os.path.join(pth, exe)))
+
+    def _cache_key(self, *parts):
+        """[Private] Return the cache key of this alignment, binary and
+        the parts given.  The alignment is normalized, so formatting differences
+        in otherwise identical input do not produce different keys."""
+        try:
+            phylip = '\n'.join([aln.to_phylip() for aln in iter_phylip(open(self.phylip, 'rU'))])
+        except ValueError:
+            phylip = None
+        if not phylip:
+            phylip = open(self.phylip, 'rb').read()
+        trees = [getattr(self, name, None) for name in ['starting_tree', 'constraint_tree']]
+        trees = [open(tree, 'rU').read() if tree else '' for tree in trees]
+        return self.cache.key(phylip, get_binary_checksum(self.binary), *(trees + list(parts)))
 
     def _get_taxon_and_char_data(self):
         """[Private] Parse the first line of a phylip file and return nchar and ntax"""
@@ -438,17 +1281,6 @@ class Phyml:
         # calculate to keep results comparable to mr_aic.pl
         self.nbranch = (2 * self.taxa) - 3
 
-    def _get_log_like(self, statfile, regex, phylip):
-        """"[Private] Given an input phyml stats file, return the log-likelihood of the tree"""
-        result = None
-        for line in open(statfile, 'rU'):
-            result = regex.search(line)
-            if result:
-                break
-        if result is None:
-            raise ValueError("No Log-likelihood found")
-        return float(result.groups()[0])
-
     def _get_tree(self, treefile):
         """[Private] Return the tree produced for a given subs. model"""
         tree = None
@@ -471,48 +1303,149 @@ class Phyml:
             params = self.numparams[model]
         return -2. * loglik + 2. * params + ((2. * params * (params + 1.)) / (self.nchar - params - 1.))
 
-    def _runner(self, phylip, model):
-        """[Private] Given alignment and model, run phyml"""
-        statfile, treefile = [''.join([phylip, ext]) for ext in ['_phyml_stats.txt', '_phyml_tree.txt']]
-        # Delete existing files from previous runs
+    def _record_run(self, model_name, stage, start, rusage):
+        """[Private] Write the telemetry of a run, if we have a sink"""
+        if not self.telemetry:
+            return
+        if not hasattr(self, 'nchar'):
+            self._get_taxon_and_char_data()
+        if not hasattr(self, 'npatterns'):
+            # the work of a run, for CostModel
+            try:
+                self.npatterns = sum([aln.site_patterns().npatterns for aln in iter_phylip(open(self.phylip, 'rU'))])
+            except ValueError:
+                self.npatterns = None
+        self.telemetry.write({
+                'time': start,
+                'locus': self.locus,
+                'model': model_name,
+                'stage': stage or self.stage,
+                'ntax': self.taxa,
+                'nchar': self.nchar,
+                'datasets': self.datasets,
+                'patterns': self.npatterns,
+                'wall': time.time() - start,
+                'user': rusage.ru_utime,
+                'sys': rusage.ru_stime,
+                # kilobytes on linux, bytes on OS X
+                'maxrss': rusage.ru_maxrss
+            })
+
+    def _launch_model(self, model_name, phylip=None):
+        """[Private] Start the program for a model without waiting for it,
+        returning the process and its outputs, for _parse_outputs().  Unless
+        phylip is given, the model runs on its own copy of the alignment."""
+        raise NotImplementedError
+
+    def _parse_outputs(self, outputs):
+        """[Private] Return the lnl and tree of a finished run"""
+        raise NotImplementedError
+
+    def _parse_parameters(self, outputs):
+        """[Private] Return the model parameters fitted by a finished run"""
+        return {}
+
+    def _model_phylip(self, model_name):
+        """[Private] Copy the alignment for a model, so that concurrent runs
+        of different models do not overwrite each other's output"""
+        model_phylip = "%s_%s" % (self.phylip, model_name)
+        if model_phylip not in self._files:
+            shutil.copyfile(self.phylip, model_phylip)
+            self._files.add(model_phylip)
+        return model_phylip
+
+    def _model_runner(self, params):
+        """[Private] Run one model, returning the model name, lnl and tree"""
+        model_name, phylip = params
+        start = time.time()
+        process, outputs = self._launch_model(model_name, phylip)
+        self._record_run(model_name, 'model selection', start, wait_rusage(process))
+        lnl, tree = self._parse_outputs(outputs)
+        return model_name, lnl, tree, self._parse_parameters(outputs)
+
+    def _run_models(self, model_names):
+        """[Private] Run each model, concurrently if self.threads > 1,
+        and record lnl, AICc and tree"""
+        phylip = self.phylip
+        if self.threads > 1 and len(model_names) > 1:
+            # programs name their output after their input, so each
+            # concurrent model gets its own copy of the alignment.  Threads
+            # suffice because the work happens in the subprocesses.
+            params = [(model_name, self._model_phylip(model_name)) for model_name in model_names]
+            pool = ThreadPool(min(self.threads, len(params)))
+            try:
+                results = pool.map(self._model_runner, params)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            results = [self._model_runner((model_name, phylip)) for model_name in model_names]
+        # merge in model order, as when models are run one after another
+        for model_name, lnl, tree, parameters in results:
+            self.add_model_result(model_name, lnl, tree, parameters)
+
+    def add_model_result(self, model_name, lnl, tree, parameters=None):
+        """Record the lnl, tree and fitted parameters of a model, e.g. as run
+        by a PhymlExecutor, for selection by AICc"""
+        if self.aicc_results is None:
+            self.lnl_results = {}
+            self.aicc_results = {}
+            self.parameter_results = {}
+            self.model_runs = 0
+            self._get_taxon_and_char_data()
+        self.model_runs += 1
+        self.model_runs_saved = len(self.models) - self.model_runs
+        self.lnl_results[model_name] = lnl
+        self.parameter_results[model_name] = parameters or {}
+        self.aicc_results[self._aicc(model_name, lnl)] = [model_name, tree]
+
+    def _aicc(self, model_name, lnl):
+        """[Private] Compute aicc, explaining why it fails for short alignments"""
         try:
-            [os.remove(f) for f in [statfile, treefile]]
-        except OSError, e:
-            # if no files, skip
-            if e.errno == 2:
-                pass
-        template = "%s\n%s" % (phylip, model)
-        cli = [self.phyml3]
-        subprocess.Popen(
-                cli,
-                stdin=subprocess.PIPE,
-                stdout=subprocess.PIPE
-            ).communicate(input=template)
-        return statfile, treefile
+            return self._compute_aicc(model_name, lnl)
+        except ZeroDivisionError:
+            txt = "An alignment is shorter than necessary to compute AICc. " + \
+                "Ensure alignments are longer than (# taxa + 10)."
+            raise IOError(txt)
+
+    def _model_selection_options(self):
+        """[Private] Return the options of model selection that change its
+        result, as part of its cache key"""
+        return []
+
+    def _select_models(self):
+        """[Private] Run the models to select from"""
+        self._run_models(sorted(self.models))
 
     def _best_model_runner(self, return_aicc=False):
         """Compute the best model for an alignment using AICc"""
         self.lnl_results = {}
         self.aicc_results = {}
-        # because of phyml, move to working dir
-        os.chdir(self.working)
+        self.parameter_results = {}
+        self.model_runs = 0
         self._get_taxon_and_char_data()
-        for model_name, model in self.models.iteritems():
-            phylip = os.path.basename(self.phylip)
-            # self._runner generates out phyml locus and model template
-            statfile, treefile = self._runner(phylip, model)
-            lnl = self._get_log_like(statfile, self.ll, phylip)
-            self.lnl_results[model_name] = lnl
-            try:
-                aicc = self._compute_aicc(model_name, lnl)
-            except ZeroDivisionError:
-                txt = "An alignment is shorter than necessary to compute AICc. " + \
-                    "Ensure alignments are longer than (# taxa + 10)."
-                raise IOError(txt)
-            tree = self._get_tree(treefile)
-            self.aicc_results[aicc] = [model_name, tree]
-        # move back to cwd
-        os.chdir(self.cwd)
+        if self.cache:
+            templates = ["%s=%s=%s" % (name, self.models[name], self.numparams[name]) for name in sorted(self.models)]
+            key = self._cache_key('aicc', *(self._model_selection_options() + templates))
+            cached = self.cache.get(key)
+            if cached:
+                # json returns unicode; keep str as when the program is run
+                for model_name, lnl in cached['lnl'].iteritems():
+                    self.lnl_results[str(model_name)] = lnl
+                for aicc, model_name, tree in cached['aicc']:
+                    self.aicc_results[aicc] = [str(model_name), str(tree)]
+                for model_name, parameters in cached.get('parameters', {}).iteritems():
+                    self.parameter_results[str(model_name)] = parameters
+                self.model_runs_saved = len(self.models) - len(self.lnl_results)
+                return
+        self._select_models()
+        self.model_runs_saved = len(self.models) - self.model_runs
+        if self.cache:
+            self.cache.put(key, {
+                    'lnl': self.lnl_results,
+                    'aicc': [[aicc, model_name, tree] for aicc, (model_name, tree) in self.aicc_results.iteritems()],
+                    'parameters': self.parameter_results
+                })
 
     def best_aicc_model(self):
         """Return best model; Do not recompute if models have been run"""
@@ -536,12 +1469,375 @@ class Phyml:
         best = min(self.aicc_results.keys())
         return self.aicc_results[best][0], self.aicc_results[best][1]
 
+    def best_aicc_parameters(self):
+        """Return the parameters fitted under the best model, e.g. to fix them
+        when computing bootstrap trees; Do not recompute if models have been run"""
+        if not self.aicc_results:
+            self._best_model_runner()
+        best = min(self.aicc_results.keys())
+        return self.parameter_results.get(self.aicc_results[best][0], {})
+
     def aicc_model_results(self):
         """Return all model results; Do not recompute if models have been run"""
         if not self.aicc_results:
             self._best_model_runner()
         return self.aicc_results
 
+    def run(self, model='GTR'):
+        """Compute a tree for the alignment under model, returning lnl and tree"""
+        raise NotImplementedError
+
+    def run_datasets(self, model='GTR'):
+        """Compute a tree for each alignment of a multi-dataset input in one
+        run, returning a list of (lnl, tree) in input order"""
+        raise NotImplementedError
+
+
+class Phyml(InferenceBackend):
+    """Use phyml to generate trees or help select models"""
+    name = 'phyml'
+    binaries = {'Darwin': 'PhyML3OSX'}
+    default_binary = 'PhyML3linux32'
+
+    def __init__(self, phylip, pth='bin', temp_dir=None, exe=None,
+                       starting_tree=None, constraint_tree=None, threads=1, cache=None,
+                       scratch=None, model_selection='exhaustive', fixed_topology=False,
+                       telemetry=None, stage=None, locus=None, parameters=None):
+        # model parameters (see best_aicc_parameters) to fix in run(), rather
+        # than optimise
+        self.parameters = parameters
+        # 'exhaustive' runs every model; 'hierarchical' prunes nested models
+        self.model_selection = model_selection
+        # search the tree once under topology_model, then only score the
+        # other models on it
+        self.fixed_topology = fixed_topology
+        self.topology_model = 'GTRIG'
+        self.topology = None
+        InferenceBackend.__init__(self, phylip, pth, temp_dir, exe, starting_tree, constraint_tree,
+                threads, cache, scratch, telemetry, stage, locus)
+        # model parameters taken from John Nylander's excellent mr_aic.pl
+        # http://www.abc.se/~nylander/
+        self.models = {
+                'JC69': "+\nM\nM\nM\nM\nM\nR\nY\n",
+                'JC69I': "+\nM\nM\nM\nM\nM\nV\nY\nR\nY\n",
+                'JC69G': "+\nM\nM\nM\nM\nM\nY\n",
+                'JC69IG': "+\nM\nM\nM\nM\nM\nV\nY\nY\n",
+                'F81': "+\nM\nM\nM\nM\nM\nM\nM\nF\nR\nY\n",
+                'F81I': "+\nM\nM\nM\nM\nM\nM\nM\nF\nV\nY\nR\nY\n",
+                'F81G': "+\nM\nM\nM\nM\nM\nM\nM\nF\nY\n",
+                'F81IG': "+\nM\nM\nM\nM\nM\nM\nM\nF\nV\nY\nY\n",
+                'K2P': "+\nM\nM\nM\nM\nM\nM\nT\nY\nR\nY\n",
+                'K2PI': "+\nM\nM\nM\nM\nM\nM\nT\nY\nR\nV\nY\nY\n",
+                'K2PG': "+\nM\nM\nM\nM\nM\nM\nT\nY\nY\n",
+                'K2PIG': "+\nM\nM\nM\nM\nM\nM\nT\nY\nV\nY\nY\n",
+                'HKY': "+\nF\nT\nY\nR\nY\n",
+                'HKYI': "+\nF\nT\nY\nR\nV\nY\nY\n",
+                'HKYG': "+\nF\nT\nY\nY\n",
+                'HKYIG': "+\nF\nT\nY\nV\nY\nY\n",
+                'SYM': "+\nM\nM\nM\nM\nE\n0.25\n0.25\n0.25\n0.25\nK\n012345\n1.00\n1.00\n1.00\n1.00\n1.00\n1.00\nR\nY\n",
+                'SYMI': "+\nM\nM\nM\nM\nE\n0.25\n0.25\n0.25\n0.25\nK\n012345\n1.00\n1.00\n1.00\n1.00\n1.00\n1.00\nR\nV\nY\nY\n",
+                'SYMG': "+\nM\nM\nM\nM\nE\n0.25\n0.25\n0.25\n0.25\nK\n012345\n1.00\n1.00\n1.00\n1.00\n1.00\n1.00\nY\n",
+                'SYMIG': "+\nM\nM\nM\nM\nE\n0.25\n0.25\n0.25\n0.25\nK\n012345\n1.00\n1.00\n1.00\n1.00\n1.00\n1.00\nV\nY\nY\n",
+                'GTR': "+\nM\nM\nM\nF\nR\nY\n",
+                'GTRI': "+\nM\nM\nM\nF\nR\nV\nY\nY\n",
+                'GTRG': "+\nM\nM\nM\nF\nY\n",
+                'GTRIG': "+\nM\nM\nM\nF\nV\nY\nY\n"
+            }
+        self.numparams = {
+                'JC69': 0,
+                'JC69I': 1,
+                'JC69G': 1,
+                'JC69IG': 2,
+                'F81': 3,
+                'F81I': 4,
+                'F81G': 4,
+                'F81IG': 5,
+                'K2P': 1,
+                'K2PI': 2,
+                'K2PG': 2,
+                'K2PIG': 3,
+                'HKY': 4,
+                'HKYI': 5,
+                'HKYG': 5,
+                'HKYIG': 6,
+                'SYM': 5,
+                'SYMI': 6,
+                'SYMG': 6,
+                'SYMIG': 7,
+                'GTR': 8,
+                'GTRI': 9,
+                'GTRG': 9,
+                'GTRIG': 10
+            }
+        # base matrices and the base matrices nested within them
+        self.model_hierarchy = {
+                'JC69': [],
+                'F81': ['JC69'],
+                'K2P': ['JC69'],
+                'HKY': ['F81', 'K2P'],
+                'SYM': ['K2P'],
+                'GTR': ['HKY', 'SYM']
+            }
+        # walk from the top, so every run bounds the models nested within it
+        self.model_hierarchy_order = ['GTR', 'SYM', 'HKY', 'K2P', 'F81', 'JC69']
+        # base matrices as custom models, in which parameters can be fixed
+        self.custom_models = {
+                'JC69': '000000',
+                'F81': '000000',
+                'K2P': '010010',
+                'HKY': '010010',
+                'SYM': '012345',
+                'GTR': '012345'
+            }
+        # compile regex for LnL once
+        self.ll = re.compile("Log-likelihood:\s+(.+)")
+        # and for the fitted parameters
+        self.parameter_regexes = {
+                'alpha': re.compile("Gamma shape parameter:\s+(\S+)"),
+                'pinv': re.compile("Proportion of invariant:\s+(\S+)"),
+                'kappa': re.compile("Transition/transversion ratio:\s+(\S+)"),
+                'freqs': re.compile("f\([ACGT]\)=\s*(\S+)"),
+                'rates': re.compile("^\s+[ACGT] <-> [ACGT]\s+(\S+)")
+            }
+
+    def _get_log_like(self, statfile, regex, phylip):
+        """"[Private] Given an input phyml stats file, return the log-likelihood of the tree"""
+        result = None
+        for line in open(statfile, 'rU'):
+            result = regex.search(line)
+            if result:
+                break
+        if result is None:
+            raise ValueError("No Log-likelihood found")
+        return float(result.groups()[0])
+
+    def _get_parameters(self, statfile):
+        """[Private] Given a phyml stats file, return the fitted parameters of
+        the (first) data set: alpha, pinv, kappa, freqs (ACGT) and rates (AC,
+        AG, AT, CG, CT, GT), as far as the model has them"""
+        parameters = {}
+        data_sets = 0
+        for line in open(statfile, 'rU'):
+            if line.startswith('. Data set:'):
+                data_sets += 1
+                if data_sets > 1:
+                    break
+            for name, regex in self.parameter_regexes.iteritems():
+                result = regex.search(line)
+                if result:
+                    value = float(result.groups()[0])
+                    if name in ['freqs', 'rates']:
+                        parameters.setdefault(name, []).append(value)
+                    else:
+                        parameters[name] = value
+        return parameters
+
+    def _get_log_likes(self, statfile):
+        """[Private] Given a phyml stats file of several data sets, return the
+        log-likelihood of the tree of each, in order"""
+        return [float(result.groups()[0]) for result in
+                [self.ll.search(line) for line in open(statfile, 'rU')] if result]
+
+    def _get_trees(self, treefile):
+        """[Private] Return the trees, one per line, produced for several data sets"""
+        return [line.strip() for line in open(treefile, 'rU') if line.strip()]
+
+    def _runner(self, phylip, model, model_name=None, stage=None):
+        """[Private] Given alignment and model, run phyml.  phylip is an
+        absolute path, and phyml runs with the working dir as its cwd, so the
+        process-wide cwd is never changed and instances may run on threads"""
+        start = time.time()
+        process, statfile, treefile = self._launch(phylip, model)
+        rusage = wait_rusage(process)
+        self._record_run(model_name, stage, start, rusage)
+        return statfile, treefile
+
+    def _launch(self, phylip, model):
+        """[Private] Start phyml without waiting for it, returning the process
+        and the stats and tree files it will write"""
+        statfile, treefile = [''.join([phylip, ext]) for ext in ['_phyml_stats.txt', '_phyml_tree.txt']]
+        self._files.update([statfile, treefile])
+        # Delete existing files from previous runs
+        for f in [statfile, treefile]:
+            try:
+                os.remove(f)
+            except OSError, e:
+                # if no files, skip
+                if e.errno != 2:
+                    raise
+        devnull = open(os.devnull, 'w')
+        process = subprocess.Popen(
+                [self.binary],
+                stdin=subprocess.PIPE,
+                stdout=devnull,
+                cwd=self.working
+            )
+        devnull.close()
+        # menu input is far smaller than a pipe buffer, so this won't block
+        try:
+            process.stdin.write("%s\n%s" % (phylip, model))
+            process.stdin.close()
+        except IOError:
+            # phyml exited early; reported when its output is parsed
+            pass
+        return process, statfile, treefile
+
+    def _launch_model(self, model_name, phylip=None):
+        """[Private] Start phyml for a model without waiting for it, returning
+        the process and the stats and tree files it will write"""
+        if phylip is None:
+            phylip = self._model_phylip(model_name)
+        process, statfile, treefile = self._launch(phylip, self._model_template(model_name))
+        return process, (statfile, treefile)
+
+    def _parse_outputs(self, outputs):
+        """[Private] Return the lnl and tree of a finished phyml run"""
+        statfile, treefile = outputs
+        return self._get_log_like(statfile, self.ll, self.phylip), self._get_tree(treefile)
+
+    def _parse_parameters(self, outputs):
+        """[Private] Return the model parameters fitted by a finished phyml run"""
+        statfile, treefile = outputs
+        return self._get_parameters(statfile)
+
+    def _model_template(self, model_name):
+        """[Private] Return the menu template of a model, with the parameters
+        and tree options of run()"""
+        model = self._run_template(model_name)
+        if self.topology:
+            model = self._fixed_topology_template(model, self.topology)
+        elif self.starting_tree:
+            model = self._user_tree_template(model, self.starting_tree)
+        return model
+
+    def _run_template(self, model_name):
+        """[Private] Return the menu template of run(), fixing self.parameters
+        if we have them"""
+        if self.parameters:
+            return self._fixed_parameters_template(model_name, self.parameters)
+        return self.models[model_name]
+
+    def _user_tree_template(self, model, treefile, optimise_topology=True):
+        """[Private] Change a model template to start from the tree in treefile
+        rather than a BioNJ tree"""
+        # from the substitution model menu, move to the tree menu and select a
+        # user tree (U twice).  phyml asks for the tree file after the run is
+        # started (Y)
+        assert model.endswith("Y\n"), "Model templates must end by starting the run"
+        if optimise_topology:
+            return "%s+\nU\nU\nY\n%s\n" % (model[:-2], treefile)
+        # turn off topology optimisation (O)
+        return "%s+\nU\nU\nO\nY\n%s\n" % (model[:-2], treefile)
+
+    def _fixed_parameters_template(self, model_name, parameters):
+        """[Private] Return a template of model_name that fixes the parameters
+        given (see _get_parameters) rather than optimising them, by entering
+        the model as a custom model.  Only topology and branch lengths are
+        optimised."""
+        base, rates = self._split_model(model_name)
+        if base in ['JC69', 'K2P', 'SYM']:
+            freqs = [0.25] * 4
+        else:
+            # phyml stops to ask for a key if user frequencies do not sum to
+            # one, as rounded frequencies may not
+            freqs = [round(freq, 5) for freq in parameters['freqs'][:3]]
+            freqs.append(1. - sum(freqs))
+        if base in ['JC69', 'F81']:
+            values = [1.]
+        elif base in ['K2P', 'HKY']:
+            # transversions, then transitions
+            values = [1., parameters['kappa']]
+        else:
+            values = parameters['rates']
+        # select the custom model (M), set user frequencies (E) and relative
+        # rates (K), and turn off rate optimisation (O)
+        template = "+\nM\nM\nM\nM\nE\n%s\nK\n%s\n%s\nO\n" % (
+                '\n'.join(["%.5f" % freq for freq in freqs]),
+                self.custom_models[base],
+                '\n'.join(["%.5f" % value for value in values])
+            )
+        if 'I' in rates:
+            template += "V\nn\n%.5f\n" % parameters['pinv']
+        if 'G' in rates:
+            template += "A\nn\n%.5f\n" % parameters['alpha']
+        else:
+            template += "R\n"
+        return template + "Y\n"
+
+    def _fixed_topology_template(self, model, treefile):
+        """[Private] Change a model template to optimise only branch lengths and
+        rates on the tree in treefile, rather than search for a tree"""
+        return self._user_tree_template(model, treefile, optimise_topology=False)
+
+    def _split_model(self, model_name):
+        """[Private] Split a model name into its base matrix and rate heterogeneity (I, G, IG)"""
+        for rates in ['IG', 'I', 'G']:
+            if model_name.endswith(rates) and model_name[:-len(rates)] in self.model_hierarchy:
+                return model_name[:-len(rates)], rates
+        return model_name, ''
+
+    def _nests(self, model_name, submodel_name):
+        """[Private] Return True if submodel is a special case of model"""
+        base, rates = self._split_model(model_name)
+        subbase, subrates = self._split_model(submodel_name)
+        if not set(subrates) <= set(rates):
+            return False
+        bases = [base]
+        while bases:
+            base = bases.pop()
+            if base == subbase:
+                return True
+            bases.extend(self.model_hierarchy[base])
+        return False
+
+    def _aicc_lower_bound(self, model_name):
+        """[Private] Return the lowest AICc model could reach.  A model cannot
+        fit better than any model it is nested in, so its lnL is bounded by
+        the lowest lnL of the models run so far that nest it."""
+        bounds = [lnl for name, lnl in self.lnl_results.iteritems() if self._nests(name, model_name)]
+        if not bounds:
+            return None
+        return self._aicc(model_name, min(bounds))
+
+    def _hierarchical_model_runner(self):
+        """[Private] Walk the nested model hierarchy from GTRIG down, skipping
+        models whose AICc cannot beat the best found so far.  Each run
+        searches its own tree, so the bound is exact only as far as phyml
+        finds the ML tree for every model."""
+        for base in self.model_hierarchy_order:
+            # richest rate heterogeneity first; +I and +G can run together
+            for group in [['IG'], ['G', 'I'], ['']]:
+                names = []
+                for name in [base + rates for rates in group]:
+                    if name in self.lnl_results:
+                        # already run, e.g. to fix the topology
+                        continue
+                    bound = self._aicc_lower_bound(name)
+                    if bound is None or bound < min(self.aicc_results):
+                        names.append(name)
+                if names:
+                    self._run_models(names)
+
+    def _model_selection_options(self):
+        """[Private] Return the options of model selection that change its
+        result, as part of its cache key"""
+        return [self.model_selection, str(self.fixed_topology)]
+
+    def _select_models(self):
+        """[Private] Run the models to select from, as set by fixed_topology
+        and model_selection"""
+        if self.fixed_topology:
+            # search for the tree once, under the richest model
+            self._run_models([self.topology_model])
+            tree = self.aicc_results[min(self.aicc_results)][1]
+            self.topology = self._string_2_tempfile(string=tree, suffix='tree')
+        if self.model_selection == 'hierarchical':
+            self._hierarchical_model_runner()
+        elif self.model_selection == 'exhaustive':
+            self._run_models([name for name in self.models if name not in self.lnl_results])
+        else:
+            raise ValueError("Unknown model selection strategy: %s" % self.model_selection)
+
     def run(self, model='GTR'):
         """
         Compute a phyml tree for the alignment given and subs model.  Tree output
@@ -550,19 +1846,290 @@ class Phyml:
         is model structure from self.models, rather than model test, since phyml
         requires custom input for anything other than several standard models.
         """
-        # because of phyml, move to working dir
-        os.chdir(self.working)
-        phylip = os.path.basename(self.phylip)
-        # run phyml
-        try:
-            statfile, treefile = self._runner(phylip, self.models[model])
-        except KeyError:
+        phylip = self.phylip
+        if model not in self.models:
             raise KeyError("You must use a valid model: %s" % (','.join(sorted(self.models.keys()))))
+        if self.cache:
+            key = self._cache_key('run', self._run_template(model))
+            cached = self.cache.get(key)
+            if cached:
+                return str(cached['lnl']), str(cached['tree'])
+        template = self._run_template(model)
+        if self.starting_tree:
+            template = self._user_tree_template(template, self.starting_tree)
+        # run phyml
+        statfile, treefile = self._runner(phylip, template, model)
         # get tree
         tree = self._get_tree(treefile)
         # get LnL
         lnl = self._get_log_like(statfile, self.ll, phylip)
-        # move back to cwd
-        os.chdir(self.cwd)
+        if self.cache:
+            self.cache.put(key, {'lnl': str(lnl), 'tree': tree})
+        return str(lnl), tree
+
+    def run_datasets(self, model='GTR'):
+        """
+        Compute a phyml tree under model for each data set of a multi-dataset
+        alignment (e.g. bootstrap replicates of a locus), in one run of phyml
+        rather than one per data set.  Returns a list of (lnl, tree), in the
+        order of the data sets.
+        """
+        if model not in self.models:
+            raise KeyError("You must use a valid model: %s" % (','.join(sorted(self.models.keys()))))
+        if self.cache:
+            key = self._cache_key('datasets', str(self.datasets), self._run_template(model))
+            cached = self.cache.get(key)
+            if cached:
+                return [(str(lnl), str(tree)) for lnl, tree in cached]
+        template = self._run_template(model)
+        if self.starting_tree:
+            # every data set starts from the same tree
+            template = self._user_tree_template(template, self.starting_tree)
+        # analyse multiple data sets (M), then set up the model as for one
+        template = "M\n%s\n%s" % (self.datasets, template)
+        statfile, treefile = self._runner(self.phylip, template, model)
+        lnls = self._get_log_likes(statfile)
+        trees = self._get_trees(treefile)
+        if not len(lnls) == len(trees) == self.datasets:
+            raise ValueError("Expected %s trees, found %s" % (self.datasets, len(trees)))
+        results = [(str(lnl), tree) for lnl, tree in zip(lnls, trees)]
+        if self.cache:
+            self.cache.put(key, results)
+        return results
+
+
+class FastTree(InferenceBackend):
+    """Use FastTree to generate approximately-maximum-likelihood trees, much
+    faster than phyml on large alignments, e.g. for bootstrap replicates.
+    FastTree only offers JC and GTR, with or without gamma rates, so run()
+    uses the nearest of these to the model given."""
+    name = 'fasttree'
+    # the bundled FastTree is a Mach-O binary; elsewhere it must be given
+    binaries = {'Darwin': 'FastTree'}
+    default_binary = None
+
+    def __init__(self, phylip, pth='bin', temp_dir=None, exe=None,
+                       starting_tree=None, constraint_tree=None, threads=1, cache=None,
+                       scratch=None, telemetry=None, stage=None, locus=None, parameters=None):
+        if constraint_tree != None:
+            raise ValueError("FastTree does not take a constraint tree.")
+        if parameters:
+            raise ValueError("FastTree does not take fixed model parameters.")
+        InferenceBackend.__init__(self, phylip, pth, temp_dir, exe, starting_tree, constraint_tree,
+                threads, cache, scratch, telemetry, stage, locus)
+        # without gamma, turn off the CAT approximation so that the lnl is of
+        # a single rate category; with it, FastTree reports the Gamma20 lnl
+        self.models = {
+                'JC69': ['-nocat'],
+                'JC69G': ['-gamma'],
+                'GTR': ['-gtr', '-nocat'],
+                'GTRG': ['-gtr', '-gamma']
+            }
+        self.numparams = {
+                'JC69': 0,
+                'JC69G': 1,
+                'GTR': 8,
+                'GTRG': 9
+            }
+        # the models of phyml, which run() accepts
+        self.model_names = re.compile("(JC69|F81|K2P|HKY|SYM|GTR)(IG|I|G)?$")
+
+    def _nearest_model(self, model_name):
+        """[Private] Return the FastTree model nearest to a phyml model"""
+        match = self.model_names.match(model_name)
+        if not match:
+            raise KeyError("You must use a valid model: %s" % (','.join(sorted(self.models.keys()))))
+        base, rates = match.groups()
+        if base != 'JC69':
+            base = 'GTR'
+        # FastTree has no invariant sites
+        if rates and 'G' in rates:
+            return base + 'G'
+        return base
+
+    def _launch_model(self, model_name, phylip=None):
+        """[Private] Start FastTree for a model without waiting for it,
+        returning the process and the log and tree files it will write"""
+        if phylip is None:
+            phylip = self._model_phylip(model_name)
+        logfile, treefile = [''.join([phylip, ext]) for ext in ['_fasttree_log.txt', '_fasttree_tree.txt']]
+        self._files.update([logfile, treefile])
+        cli = [self.binary, '-nt', '-quiet', '-nopr', '-nosupport', '-log', logfile] + self.models[model_name]
+        if self.starting_tree:
+            cli.extend(['-intree', self.starting_tree])
+        cli.append(phylip)
+        # FastTree writes the tree to stdout
+        out = open(treefile, 'w')
+        process = subprocess.Popen(
+                cli,
+                stdout=out,
+                cwd=self.working
+            )
+        out.close()
+        return process, (logfile, treefile)
+
+    def _get_log_like(self, logfile):
+        """[Private] Given a FastTree log, return the log-likelihood of the
+        final tree: the Gamma20LogLk of gamma models, else the last TreeLogLk"""
+        lnl = gamma = None
+        for line in open(logfile, 'rU'):
+            fields = line.rstrip('\n').split('\t')
+            if fields[0] == 'TreeLogLk' and len(fields) > 2:
+                lnl = float(fields[2])
+            elif fields[0].startswith('Gamma') and fields[0].endswith('LogLk'):
+                gamma = float(fields[1])
+        if gamma is not None:
+            return gamma
+        if lnl is None:
+            raise ValueError("No Log-likelihood found")
+        return lnl
+
+    def _parse_outputs(self, outputs):
+        """[Private] Return the lnl and tree of a finished FastTree run"""
+        logfile, treefile = outputs
+        return self._get_log_like(logfile), self._get_tree(treefile)
+
+    def run(self, model='GTR'):
+        """Compute a FastTree tree for the alignment under the FastTree model
+        nearest to model.  Returns lnl and tree, as Phyml.run() does."""
+        model = self._nearest_model(model)
+        if self.cache:
+            key = self._cache_key('run', *self.models[model])
+            cached = self.cache.get(key)
+            if cached:
+                return str(cached['lnl']), str(cached['tree'])
+        start = time.time()
+        process, outputs = self._launch_model(model, self.phylip)
+        self._record_run(model, None, start, wait_rusage(process))
+        lnl, tree = self._parse_outputs(outputs)
+        if self.cache:
+            self.cache.put(key, {'lnl': str(lnl), 'tree': tree})
         return str(lnl), tree
 
+
+# inference backends, by the name used to select them on the CLI
+BACKENDS = {}
+
+
+def register_backend(backend):
+    """Make an InferenceBackend subclass selectable by its name"""
+    BACKENDS[backend.name] = backend
+    return backend
+
+
+def get_backend(name):
+    """Return the InferenceBackend subclass registered under name"""
+    try:
+        return BACKENDS[name]
+    except KeyError:
+        raise ValueError("Unknown backend: %s (choose from %s)" % (name, ', '.join(sorted(BACKENDS))))
+
+
+register_backend(Phyml)
+register_backend(FastTree)
+
+
+class PhymlResult(namedtuple('PhymlResult', 'locus model lnl tree parameters')):
+    """The result of a phyml run by a PhymlExecutor"""
+    __slots__ = ()
+
+
+class PhymlExecutor(object):
+    """Run many phyml processes from one python process, at most max_running
+    at once (default: one per core).  Runs are polled rather than waited on,
+    so no thread or process is needed per run.  Runs taking longer than
+    timeout seconds are killed.  Failed and timed out runs are not yielded,
+    but recorded in self.failures as (locus, model, reason).  Runs of any
+    InferenceBackend, e.g. FastTree, may be mixed."""
+    def __init__(self, max_running=None, timeout=None, poll_interval=0.05):
+        if not max_running:
+            max_running = cpu_count()
+        self.max_running = max_running
+        self.timeout = timeout
+        self.poll_interval = poll_interval
+        self.pending = []
+        self.running = []
+        self.failures = []
+        self.cancelled = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.cancel()
+
+    def submit(self, phyml, model_name, locus=None):
+        """Queue a run of phyml under model_name"""
+        self.pending.append((locus, phyml, model_name))
+
+    def cancel(self):
+        """Kill running processes and drop queued runs"""
+        self.cancelled = True
+        self.pending = []
+        for locus, phyml, model_name, process, outputs, start in self.running:
+            if process.poll() is None:
+                process.kill()
+                process.wait()
+        self.running = []
+
+    def _start(self, locus, phyml, model_name):
+        """[Private] Launch a run"""
+        process, outputs = phyml._launch_model(model_name)
+        self.running.append((locus, phyml, model_name, process, outputs, time.time()))
+
+    def _finish(self, run):
+        """[Private] Parse the output of a finished run, or record its failure"""
+        locus, phyml, model_name, process, outputs, start = run
+        if process.returncode != 0:
+            self.failures.append((locus, model_name, "%s exited with %s" % (phyml.name, process.returncode)))
+            return None
+        try:
+            lnl, tree = phyml._parse_outputs(outputs)
+            parameters = phyml._parse_parameters(outputs)
+        except (IOError, ValueError), e:
+            self.failures.append((locus, model_name, str(e)))
+            return None
+        return PhymlResult(locus, model_name, lnl, tree, parameters)
+
+    def as_completed(self, tasks=()):
+        """Yield a PhymlResult for each run as it completes.  tasks is an
+        iterable of (locus, phyml, model_name), consumed only as runs finish,
+        in addition to any runs submitted."""
+        tasks = iter(tasks)
+        self.cancelled = False
+        try:
+            while not self.cancelled:
+                # fill free slots, queued runs first
+                while len(self.running) < self.max_running:
+                    if self.pending:
+                        self._start(*self.pending.pop(0))
+                        continue
+                    try:
+                        self._start(*tasks.next())
+                    except StopIteration:
+                        break
+                if not self.running:
+                    break
+                finished = []
+                for run in self.running:
+                    run[3].rusage = wait_rusage(run[3], block=False)
+                    if run[3].rusage is not None:
+                        finished.append(run)
+                for run in finished:
+                    self.running.remove(run)
+                    run[1]._record_run(run[2], None, run[5], run[3].rusage)
+                    result = self._finish(run)
+                    if result:
+                        yield result
+                if self.timeout:
+                    for run in [run for run in self.running if time.time() - run[5] > self.timeout]:
+                        run[3].kill()
+                        run[3].wait()
+                        self.running.remove(run)
+                        self.failures.append((run[0], run[2], "timed out after %s s" % self.timeout))
+                if not finished:
+                    time.sleep(self.poll_interval)
+        finally:
+            # the caller stopped iterating early
+            if self.running:
+                self.cancel()
@@ -19,6 +19,14 @@ import os
 import sys
 import glob
 import argparse
+import functools
+import itertools
+import multiprocessing
+try:
+    from cloudforest.core import Alignment, DatasetWriter
+except ImportError:
+    # running from within the source directory
+    from core import Alignment, DatasetWriter
 
 def get_args():
     """Parse sys.argv"""
@@ -26,90 +34,125 @@ def get_args():
     parser.add_argument('-i','--input-dir', 
         required=True, 
         help='The input directory containing the nexus files.')
+    parser.add_argument('-b','--binary',
+        default=None,
+        help='Write an indexed binary dataset to this file instead of oneliners to stdout.')
+    parser.add_argument('-c','--cores',
+        type=int,
+        default=1,
+        help='The number of nexus files to process in parallel.')
+    parser.add_argument('-m','--mask-ambiguous',
+        action='store_true',
+        default=False,
+        help='Convert bases other than A, T, C or G (e.g. N, IUPAC codes) to gaps.')
     args = parser.parse_args()
     return args
 
+# translation table mapping anything other than A, T, C or G to a gap
+AMBIGUOUS_TO_GAP = ''.join([c if c in 'ATCG' else '-' for c in map(chr, range(256))])
+MISSING_CHARS = '?-'
+
 def isSeqOK(seq):
-    """Checks that seq doesn't contain """
-    numb_of_qs = 0
-    for char in seq:
-        if char == "?" or char == "-":
-            numb_of_qs +=1
-    
-    if numb_of_qs == len(seq): return False
-    if numb_of_qs < len(seq): return True
+    """Checks that seq doesn't contain only missing data (? or -)"""
+    return len(seq.translate(None, MISSING_CHARS)) > 0
 
 def removeAmbiguousBases(seq):
     """ Converts ambiguous bases to - as required by PhyML"""
-    new_seq = ""
-    for char in seq:
-        if char not in  ["A", "T", "C", "G"]:
-            char = "-"
-        new_seq += char
-    return new_seq
-
-def nexus2oneliner(fin, name=None):
-    """Does the main processing of the nexus files"""
-    
-    as_one_liner = False
+    return seq.translate(AMBIGUOUS_TO_GAP)
+
+def shortenTaxonName(taxon):
+    """Abbreviates genus_species taxon names to eight characters (e.g., HomSapie)"""
+    if '_' in taxon:
+        genus, species = taxon.split('_')[-2:]
+        genus_trunc = '%s%s' % (genus[0].upper(), genus[1:3])
+        species_cap =  '%s%s' % (species[0].upper(), species[1:])
+        taxon = genus_trunc + species_cap
+        return taxon[:8]
+    return taxon[0].upper() + taxon[1:8]
+
+def iterNexusMatrix(fin):
+    """Lazily yields the matrix of each alignment in fin as a list of 
+    (taxon, sequence) tuples, in the order taxa first appear. Reads one 
+    line at a time, so files holding many concatenated alignments are 
+    never held in memory whole.  Interleaved matrices are joined per taxon."""
     in_data = False
-    final_line = ''
-    align_count = 0
-    for count, line in enumerate(fin): 
-        
-        if "#NEXUS" in line:
-            in_data = False
-            if as_one_liner == True and len(final_line) != 0:
-                sys.stdout.write(final_line + ";")
-            if as_one_liner == False and len(final_line) != 0:
-                sys.stdout.write(final_line + ";\n")
-            final_line = ''
-            align_count += 1
-        
-        if in_data == True:
-            
-            if ';' not in line:
-   
-                if len(line.strip()) == 0: continue
-                taxon, seq = line.strip().split()
-                #seq = removeAmbiguousBases(seq)     # remove any ambiguous bases (e.g,. not A,T,C, or G)
-                if isSeqOK(seq) == False: continue  # skip taxa with no data (= all ?????)
-    
-                if '_' in taxon:
-                    # taxon = taxon.split('_')[-1]
-                    genus, species = taxon.split('_')[-2:]
-                    genus_trunc = '%s%s' % (genus[0].upper(), genus[1:3])
-                    species_cap =  '%s%s' % (species[0].upper(), species[1:])
-                    taxon = genus_trunc + species_cap
-                    taxon =  taxon[:8]
-                else:
-                    taxon = taxon[0].upper() + taxon[1:8]
-                
-                if final_line == '':
-                    final_line = taxon +','+ seq
-                else:
-                    final_line += ',' + taxon +','+ seq
-                        
-        if 'matrix' in line:
+    order = []
+    chunks = {}
+    for line in fin:
+        if in_data:
+            done = ';' in line
+            words = line.split(';')[0].split()
+            if words:
+                taxon = words[0]
+                if taxon not in chunks:
+                    order.append(taxon)
+                    chunks[taxon] = []
+                chunks[taxon].extend(words[1:])
+            if done:
+                yield [(taxon, ''.join(chunks[taxon])) for taxon in order]
+                in_data = False
+                order = []
+                chunks = {}
+        elif line.strip().lower().split()[:1] == ['matrix']:
+            # the MATRIX command, not e.g. a comment or title mentioning it
             in_data = True
-    
-    if as_one_liner == True:
-        return final_line + ";"
-    else:
-        return "chrm=" + name + ":" + final_line + ";\n"
-
+    if order:
+        # unterminated matrix at end of file
+        yield [(taxon, ''.join(chunks[taxon])) for taxon in order]
+
+def nexus2oneliner(fin, name=None, mask=False):
+    """Does the main processing of the nexus files.  Taxa with no data 
+    (= all ?????) are dropped, and alignments left without taxa skipped.  With mask, ambiguous bases are converted to
+    gaps.  If fin holds more than one alignment, one oneliner is returned 
+    per line, the second and later named name_2, name_3, etc."""
+    oneliners = []
+    for count, matrix in enumerate(iterNexusMatrix(fin)):
+        if mask:
+            matrix = [(taxon, removeAmbiguousBases(seq)) for taxon, seq in matrix]
+        seqs = ['%s,%s' % (shortenTaxonName(taxon), seq) for taxon, seq in matrix if isSeqOK(seq)]
+        if count == 0:
+            chrm = name
+        else:
+            chrm = '%s_%s' % (name, count + 1)
+        if not seqs:
+            sys.stderr.write("[Warning] %s has no taxa with data, skipping\n" % (chrm))
+            continue
+        oneliners.append("chrm=%s:%s;\n" % (chrm, ','.join(seqs)))
+    return ''.join(oneliners)
+
+def nexusFile2oneliner(nexus_file, mask=False):
+    """Converts one nexus file to oneliner(s) named after the file"""
+    filename = os.path.split(nexus_file)[-1]
+    fileID = os.path.splitext(filename)[0]
+    fin = open(nexus_file,'rU')
+    oneliner = nexus2oneliner(fin, name=fileID, mask=mask)
+    fin.close()
+    return oneliner
 
 def processNexusFiles():
     args = get_args()
     in_dir = os.path.join(args.input_dir, "*.nex*")
-    for count, nexus_file in enumerate(glob.glob(in_dir)):
-        filename = os.path.split(nexus_file)[-1]
-        fileID = os.path.splitext(filename)[0]
-        fin = open(nexus_file,'rU')
-
-        oneliner = nexus2oneliner(fin, name=fileID)
-        sys.stdout.write(oneliner)
-        fin.close()
+    nexus_files = sorted(glob.glob(in_dir))
+    convert = functools.partial(nexusFile2oneliner, mask=args.mask_ambiguous)
+    if args.cores > 1:
+        pool = multiprocessing.Pool(args.cores)
+        # imap keeps output in file order while files are parsed in parallel
+        oneliners = pool.imap(convert, nexus_files)
+    else:
+        pool = None
+        oneliners = itertools.imap(convert, nexus_files)
+    writer = DatasetWriter(args.binary) if args.binary else None
+    for oneliner in oneliners:
+        if writer:
+            for line in oneliner.splitlines():
+                writer.write(Alignment.from_oneliner(line))
+        else:
+            sys.stdout.write(oneliner)
+    if writer:
+        writer.close()
+    if pool:
+        pool.close()
+        pool.join()
 
 
 if __name__ == '__main__':
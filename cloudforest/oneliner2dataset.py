@@ -0,0 +1,51 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+"""
+oneliner2dataset.py
+
+Converts oneliners (e.g. the output of nexus2oneliner.py or phylip2oneliner.py)
+to an indexed binary dataset, from which single loci can be read without
+parsing the rest of the data.
+
+Command line Usage: python phylip2oneliner.py -i alignments/ | python oneliner2dataset.py -o loci.cfds
+"""
+
+import sys
+import argparse
+try:
+    from cloudforest.core import Alignment, DatasetWriter
+except ImportError:
+    # running from within the source directory
+    from core import Alignment, DatasetWriter
+
+def get_args():
+    """Parse sys.argv"""
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-i','--input',
+        type=argparse.FileType('rU'),
+        default=sys.stdin,
+        help='The file of oneliners.  Defaults to stdin.')
+    parser.add_argument('-o','--output',
+        required=True,
+        help='The binary dataset file to write.')
+    args = parser.parse_args()
+    return args
+
+def iterOneliners(fin):
+    """Yield single-locus oneliners from lines that may hold several loci"""
+    for line in fin:
+        for locus in line.strip().split(';'):
+            if locus.strip():
+                yield locus
+
+def processOneliners():
+    args = get_args()
+    writer = DatasetWriter(args.output)
+    for oneliner in iterOneliners(args.input):
+        writer.write(Alignment.from_oneliner(oneliner))
+    writer.close()
+
+
+if __name__ == '__main__':
+    processOneliners()
@@ -0,0 +1,94 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+"""
+telemetry_report.py
+
+Summarizes the PhyML telemetry written by cloudforest_mpi.py --telemetry,
+by model, by locus size (taxa x characters) and by stage (genetree, model
+selection, bootstrap), so that the loci and models that dominate run time
+can be found.
+
+Command line Usage: python telemetry_report.py -i telemetry.jsonl --by model stage
+"""
+
+import sys
+import math
+import argparse
+try:
+    from cloudforest.core import read_telemetry
+except ImportError:
+    # running from within the source directory
+    from core import read_telemetry
+
+def get_args():
+    """Parse sys.argv"""
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-i','--input',
+        type=argparse.FileType('rU'),
+        default=sys.stdin,
+        help='The telemetry file.  Defaults to stdin.')
+    parser.add_argument('--by',
+        nargs='+',
+        choices=['model', 'size', 'stage', 'locus'],
+        default=['stage', 'model'],
+        help='The fields by which to group runs.')
+    args = parser.parse_args()
+    return args
+
+def sizeBucket(record):
+    """Bins the size of an alignment (taxa x characters) by powers of two"""
+    cells = record['ntax'] * record['nchar']
+    if cells < 1:
+        return '0'
+    low = 2 ** int(math.log(cells, 2))
+    return '%s-%s' % (low, 2 * low - 1)
+
+def groupKey(record, by):
+    """Returns the values of the grouping fields of a record"""
+    key = []
+    for field in by:
+        if field == 'size':
+            key.append(sizeBucket(record))
+        else:
+            key.append(str(record.get(field)))
+    return tuple(key)
+
+def summarizeTelemetry(records, by):
+    """Sums runs, wall and CPU time and takes the peak RSS of each group"""
+    groups = {}
+    for record in records:
+        key = groupKey(record, by)
+        if key not in groups:
+            groups[key] = {'runs': 0, 'wall': 0., 'cpu': 0., 'maxrss': 0}
+        group = groups[key]
+        group['runs'] += 1
+        group['wall'] += record['wall']
+        group['cpu'] += record['user'] + record['sys']
+        group['maxrss'] = max(group['maxrss'], record['maxrss'])
+    return groups
+
+def formatReport(groups, by):
+    """Formats groups as a table, most CPU time first"""
+    header = list(by) + ['runs', 'wall', 'mean_wall', 'cpu', 'cpu_share', 'maxrss']
+    total_cpu = sum([group['cpu'] for group in groups.itervalues()]) or 1.
+    lines = ['\t'.join(header)]
+    for key, group in sorted(groups.iteritems(), key=lambda item: -item[1]['cpu']):
+        lines.append('\t'.join(list(key) + [
+                str(group['runs']),
+                '%.2f' % group['wall'],
+                '%.2f' % (group['wall'] / group['runs']),
+                '%.2f' % group['cpu'],
+                '%.3f' % (group['cpu'] / total_cpu),
+                str(group['maxrss'])
+            ]))
+    return '\n'.join(lines) + '\n'
+
+def main():
+    args = get_args()
+    groups = summarizeTelemetry(read_telemetry(args.input), args.by)
+    sys.stdout.write(formatReport(groups, args.by))
+
+
+if __name__ == '__main__':
+    main()
@@ -9,8 +9,13 @@ Copyright (c) 2012 Brant C. Faircloth. All rights reserved.
 
 """
 
+import os
 import copy
+import shutil
 import cPickle
+import platform
+import urllib
+import tempfile
 import unittest
 import dendropy
 from context import cloudforest as cl
@@ -47,6 +52,69 @@ class TestProcess(unittest.TestCase):
         locus = locus[0].split(':')[1]
         return locus
 
+    def test_bootstrap_matrix(self):
+        """[Process] Batched bootstrap indices"""
+        matrix = cl.get_bootstrap_matrix(50, 20)
+        assert matrix.shape == (20, 50)
+        assert matrix.min() >= 0 and matrix.max() < 50
+
+    def test_bootstrap_weights(self):
+        """[Process] Batched bootstrap weights"""
+        counts = [5, 1, 10, 4]
+        weights = cl.get_bootstrap_weights(counts, 30)
+        assert weights.shape == (30, 4)
+        assert (weights.sum(axis=1) == 20).all()
+
+    def test_iter_bootstrap_chunks(self):
+        """[Process] Chunked bootstrap replicates"""
+        chunks = list(cl.iter_bootstrap_weights([3, 7], 7, chunk_size=3))
+        assert [len(c) for c in chunks] == [3, 3, 1]
+        # chunks hold the same draws as one call
+        chunks = cl.iter_bootstrap_weights([3, 7, 5], 7, 3, cl.get_bootstrap_rng(42, 1))
+        expected = cl.get_bootstrap_weights([3, 7, 5], 7, cl.get_bootstrap_rng(42, 1))
+        assert sum([chunk.tolist() for chunk in chunks], []) == expected.tolist()
+
+    def test_bootstrap_occurrences(self):
+        """[Process] Bootstrap occurrences across loci"""
+        occurrences = cl.get_bootstrap_occurrences(12)
+        assert len(occurrences) == 12
+        assert occurrences.sum() == 12
+
+    def test_bootstrap_rng_is_addressable(self):
+        """[Process] Seeded bootstraps are regenerated by address"""
+        first = cl.get_bootstrap_weights([4, 6, 10], 5, cl.get_bootstrap_rng(42, 3, 'chr1_1036'))
+        again = cl.get_bootstrap_weights([4, 6, 10], 5, cl.get_bootstrap_rng(42, 3, 'chr1_1036'))
+        other = cl.get_bootstrap_weights([4, 6, 10], 5, cl.get_bootstrap_rng(42, 4, 'chr1_1036'))
+        assert (first == again).all()
+        assert not (first == other).all()
+
+    def test_seeded_bootstrap_replicates(self):
+        """[Process] Seeded bootstrap replicates are reproducible"""
+        line = ''.join([l.strip() for l in open('alignments/3.oneliners', 'rU')])
+        self.p.options = type('Options', (object,), {'seed': 42})
+        first = [o for o in self.p.get_bootstrap_replicates(7, line)]
+        again = [o for o in self.p.get_bootstrap_replicates(7, line)]
+        assert first == again
+
+    def test_get_bootstrap_replicates(self):
+        """[Process] Bootstrap replicates of a multilocus oneliner"""
+        line = ''.join([l.strip() for l in open('alignments/3.oneliners', 'rU')])
+        observed = [o for o in self.p.get_bootstrap_replicates(1, line)]
+        assert len(observed) == 3
+        for key, oneliner in observed:
+            assert key == 1
+            assert oneliner.startswith('chrm=chr1_10')
+
+    def test_warm_start_tree_in_oneliner(self):
+        """[Process] A quoted genetree survives bootstrapping of its oneliner"""
+        tree = '((a:0.1,b:0.2):0.05,c:0.3);'
+        args_dict, locus = cl.split_oneliner(self.one)
+        args_dict['tree'] = urllib.quote(tree, safe='')
+        line = "%s;" % cl.Alignment.from_oneliner(self.one).to_oneliner(args_dict)
+        for key, oneliner in self.p.get_bootstrap_replicates(1, line):
+            args_dict, locus = cl.split_oneliner(oneliner)
+            assert urllib.unquote(args_dict['tree']) == tree
+
     def test_oneliner_to_array(self):
         """[Process] Oneliner to array"""
         exp_taxa = ['MusMuscu', 'GorGoril', 'PanTrogl']
@@ -132,6 +200,20 @@ class TestProcess(unittest.TestCase):
         assert obs_key == exp_key
         assert obs_tree == exp_tree
 
+    def test_get_genetrees_telemetry(self):
+        """[Process] genetrees of a full analysis are recorded as bootstrap runs"""
+        working = tempfile.mkdtemp()
+        try:
+            telemetry = os.path.join(working, 'telemetry.jsonl')
+            self.p.options = type('Options', (object,), {'full_analysis': True, 'bootstrap_backend': 'phyml',
+                    'telemetry': telemetry, 'gene_trees': False, 'mraic_opt': False})
+            observed = [o for o in self.p.get_genetrees(1, self.one, pth='../binaries')]
+            assert len(observed) == 1
+            records = list(cl.read_telemetry(open(telemetry)))
+            assert [record['stage'] for record in records] == ['bootstrap']
+        finally:
+            shutil.rmtree(working)
+
     def test_get_genetrees_and_models_for_genetrees(self):
         """[Process] genetrees_and_models yields tree"""
         obs_gen = self.p.get_genetrees_and_models(1, self.one, pth='../binaries', genetrees=True)
@@ -238,6 +320,240 @@ class TestPhymlMethods(unittest.TestCase):
                 )
             self.assertAlmostEqual(distance, 0.0, 2)
 
+    def test_slow_aicc_model_threaded(self):
+        """[Phyml] AICc results are unchanged when models run concurrently"""
+        phyml = cl.Phyml('alignments/phylip_primates/chr1_1036.phylip', pth='../binaries', threads=4)
+        expected = self.phyml.aicc_model_results()
+        observed = phyml.aicc_model_results()
+        assert sorted(observed.keys()) == sorted(expected.keys())
+        for aic in observed:
+            assert observed[aic][0] == expected[aic][0]
+        assert phyml.lnl_results == self.phyml.lnl_results
+
+    def test_model_nesting(self):
+        """[Phyml] Nesting of substitution models"""
+        assert self.phyml._split_model('GTRIG') == ('GTR', 'IG')
+        assert self.phyml._split_model('K2P') == ('K2P', '')
+        assert self.phyml._nests('GTRIG', 'JC69I')
+        assert self.phyml._nests('HKYG', 'F81G')
+        assert not self.phyml._nests('HKYG', 'F81I')
+        assert not self.phyml._nests('SYM', 'F81')
+        assert all([self.phyml._nests('GTRIG', model) for model in self.phyml.models])
+
+    def test_aicc_lower_bound(self):
+        """[Phyml] AICc of a model is bounded by the models nesting it"""
+        self.phyml._get_taxon_and_char_data()
+        self.phyml.lnl_results = {'GTRIG': -1000., 'HKY': -1100.}
+        assert self.phyml._aicc_lower_bound('K2P') == self.phyml._compute_aicc('K2P', -1100.)
+        assert self.phyml._aicc_lower_bound('SYM') == self.phyml._compute_aicc('SYM', -1000.)
+        self.phyml.lnl_results = {}
+        assert self.phyml._aicc_lower_bound('SYM') is None
+
+    def test_slow_aicc_model_hierarchical(self):
+        """[Phyml] Hierarchical model selection finds the same best model in fewer runs"""
+        phyml = cl.Phyml('alignments/phylip_primates/chr1_1036.phylip', pth='../binaries',
+                model_selection='hierarchical')
+        assert phyml.best_aicc_model() == self.phyml.best_aicc_model()
+        assert phyml.model_runs_saved > 0
+        assert phyml.model_runs + phyml.model_runs_saved == len(phyml.models)
+
+    def test_fixed_topology_template(self):
+        """[Phyml] Fixed topology templates read a user tree and keep it"""
+        template = self.phyml._fixed_topology_template(self.phyml.models['HKY'], '/tmp/tree')
+        assert template == "+\nF\nT\nY\nR\n+\nU\nU\nO\nY\n/tmp/tree\n"
+
+    def test_starting_tree_template(self):
+        """[Phyml] Starting trees are read from a user tree file"""
+        phyml = cl.Phyml('alignments/phylip_primates/chr1_1036.phylip', pth='../binaries',
+                starting_tree='(a,b,c);')
+        template = phyml._model_template('HKY')
+        assert template == "+\nF\nT\nY\nR\n+\nU\nU\nY\n%s\n" % phyml.starting_tree
+        assert open(phyml.starting_tree).read() == '(a,b,c);'
+        assert self.phyml._model_template('HKY') == self.phyml.models['HKY']
+
+    def test_slow_aicc_model_fixed_topology(self):
+        """[Phyml] Scoring models on a fixed topology finds the same best model"""
+        phyml = cl.Phyml('alignments/phylip_primates/chr1_1036.phylip', pth='../binaries',
+                fixed_topology=True)
+        assert phyml.best_aicc_model() == self.phyml.best_aicc_model()
+        assert len(phyml.lnl_results) == len(phyml.models)
+
+    def test_executor_failure(self):
+        """[PhymlExecutor] Failed runs are recorded, not yielded"""
+        phyml = cl.Phyml('alignments/phylip_primates/chr1_1036.phylip', pth='/usr/bin', exe='false')
+        executor = cl.PhymlExecutor(2)
+        executor.submit(phyml, 'GTR', 'chr1_1036')
+        assert list(executor.as_completed()) == []
+        assert executor.failures == [('chr1_1036', 'GTR', 'phyml exited with 1')]
+
+    def test_executor_timeout(self):
+        """[PhymlExecutor] Runs are killed after the timeout"""
+        phyml = cl.Phyml('alignments/phylip_primates/chr1_1036.phylip', pth='/usr/bin', exe='yes')
+        with cl.PhymlExecutor(2, timeout=0.2) as executor:
+            results = list(executor.as_completed([('a', phyml, 'GTR'), ('b', phyml, 'HKY')]))
+        assert results == []
+        assert sorted([failure[:2] for failure in executor.failures]) == [('a', 'GTR'), ('b', 'HKY')]
+        assert executor.running == []
+
+    def test_run_executor(self):
+        """[PhymlExecutor] Results match Phyml.run()"""
+        executor = cl.PhymlExecutor(2)
+        tasks = [(model, self.phyml, model) for model in ['GTR', 'HKY', 'JC69']]
+        results = dict([[result.locus, result] for result in executor.as_completed(tasks)])
+        assert sorted(results) == ['GTR', 'HKY', 'JC69']
+        for model in results:
+            self.assertAlmostEqual(results[model].lnl, float(self.phyml.run(model)[0]), 2)
+
+    def test_telemetry(self):
+        """[Phyml] Every phyml run is recorded to the telemetry sink"""
+        working = tempfile.mkdtemp()
+        sink = cl.TelemetrySink(os.path.join(working, 'telemetry.jsonl'))
+        phyml = cl.Phyml('alignments/phylip_primates/chr1_1036.phylip', pth='/usr/bin', exe='true',
+                telemetry=sink, stage='bootstrap')
+        # true writes no tree
+        self.assertRaises(IOError, phyml.run, 'GTR')
+        records = list(cl.read_telemetry(open(sink.path)))
+        shutil.rmtree(working)
+        assert len(records) == 1
+        record = records[0]
+        assert (record['locus'], record['model'], record['stage']) == ('chr1_1036', 'GTR', 'bootstrap')
+        assert (record['ntax'], record['nchar']) == (10, 430)
+        for field in ['time', 'wall', 'user', 'sys', 'maxrss']:
+            assert record[field] >= 0
+
+    def test_failed_run_keeps_cwd(self):
+        """[Phyml] A failed run leaves the cwd unchanged"""
+        cwd = os.getcwd()
+        phyml = cl.Phyml('alignments/phylip_primates/chr1_1036.phylip', pth='../binaries', exe='not_phyml')
+        self.assertRaises(OSError, phyml.run, 'GTR')
+        assert os.getcwd() == cwd
+
+    def test_context_manager(self):
+        """[Phyml] Working dir is removed on leaving a with block"""
+        with cl.Phyml('alignments/phylip_primates/chr1_1036.phylip', pth='../binaries') as phyml:
+            assert os.path.isdir(phyml.working)
+        assert not os.path.exists(phyml.working)
+        # closing again is harmless
+        phyml.close()
+
+    def test_shared_scratch(self):
+        """[Phyml] Instances in a shared scratch dir remove only their own files"""
+        scratch = cl.get_worker_scratch()
+        assert cl.get_worker_scratch() == scratch
+        phylip = 'alignments/phylip_primates/chr1_1036.phylip'
+        with cl.Phyml(phylip, pth='../binaries', scratch=scratch) as first:
+            with cl.Phyml(phylip, pth='../binaries', scratch=scratch) as second:
+                assert first.working == second.working == scratch
+                assert first.phylip != second.phylip
+            assert os.path.exists(first.phylip)
+            assert not os.path.exists(second.phylip)
+        assert os.listdir(scratch) == []
+
+    def test_run_threaded(self):
+        """[Phyml] Phyml.run() from several threads"""
+        from multiprocessing.pool import ThreadPool
+        loci = ['chr1_1036', 'chr1_1039', 'chr1_1057']
+        phymls = [cl.Phyml('alignments/phylip_primates/%s.phylip' % locus, pth='../binaries') for locus in loci]
+        pool = ThreadPool(len(phymls))
+        observed = pool.map(lambda phyml: phyml.run('GTR'), phymls)
+        pool.close()
+        expected = [phyml.run('GTR') for phyml in phymls]
+        for obs, exp in zip(observed, expected):
+            self.assertAlmostEqual(float(obs[0]), float(exp[0]), 2)
+
+    def test_multiple_datasets(self):
+        """[Phyml] Lists of alignments are written as one multi-dataset file"""
+        alns = [cl.iter_phylip(open('alignments/phylip_primates/%s.phylip' % locus)).next()
+                for locus in ['chr1_1036', 'chr1_1039']]
+        with cl.Phyml(alns, pth='../binaries') as phyml:
+            assert phyml.datasets == 2
+            observed = list(cl.iter_phylip(open(phyml.phylip)))
+        assert [aln.to_phylip() for aln in observed] == [aln.to_phylip() for aln in alns]
+
+    def test_log_likes(self):
+        """[Phyml] Parse the lnl of each data set from a stats file"""
+        statfile = os.path.join(self.phyml.working, 'stats')
+        open(statfile, 'w').write(". Data set: \t#1\n. Log-likelihood: \t-990.96043\n"
+                ". Data set: \t#2\n. Log-likelihood: \t-768.24519\n")
+        assert self.phyml._get_log_likes(statfile) == [-990.96043, -768.24519]
+
+    def test_parameters(self):
+        """[Phyml] Parse fitted parameters from a stats file"""
+        statfile = os.path.join(self.phyml.working, 'stats')
+        open(statfile, 'w').write("\n".join([
+                ". Data set: \t\t\t\t#1",
+                ". Log-likelihood: \t\t\t-982.16509",
+                ". Discrete gamma model: \t\tYes",
+                "  - Number of categories: \t\t4",
+                "  - Gamma shape parameter: \t\t99.893",
+                ". Proportion of invariant: \t\t0.230",
+                ". Nucleotides frequencies:",
+                "  - f(A)= 0.30253",
+                "  - f(C)= 0.16363",
+                "  - f(G)= 0.21176",
+                "  - f(T)= 0.32207",
+                ". GTR relative rate parameters : ",
+                "  A <-> C    2.74009",
+                "  A <-> G    4.34916",
+                "  A <-> T    0.25662",
+                "  C <-> G    1.49382",
+                "  C <-> T    3.30572",
+                "  G <-> T    1.00000",
+                ". Data set: \t\t\t\t#2",
+                ". Transition/transversion ratio: \t3.483"
+            ]))
+        assert self.phyml._get_parameters(statfile) == {
+                'alpha': 99.893,
+                'pinv': 0.23,
+                'freqs': [0.30253, 0.16363, 0.21176, 0.32207],
+                'rates': [2.74009, 4.34916, 0.25662, 1.49382, 3.30572, 1.0]
+            }
+
+    def test_fixed_parameters_template(self):
+        """[Phyml] Fixed parameters are entered as a custom model"""
+        parameters = {'alpha': 0.5, 'kappa': 3.483, 'freqs': [0.30253, 0.16363, 0.21176, 0.32207]}
+        template = self.phyml._fixed_parameters_template('HKYG', parameters)
+        # frequencies are adjusted to sum to one
+        assert template == "+\nM\nM\nM\nM\nE\n0.30253\n0.16363\n0.21176\n0.32208\n" + \
+                "K\n010010\n1.00000\n3.48300\nO\nA\nn\n0.50000\nY\n"
+        template = self.phyml._fixed_parameters_template('JC69I', {'pinv': 0.2})
+        assert template == "+\nM\nM\nM\nM\nE\n0.25000\n0.25000\n0.25000\n0.25000\n" + \
+                "K\n000000\n1.00000\nO\nV\nn\n0.20000\nR\nY\n"
+
+    def test_model_template_fixed_parameters(self):
+        """[Phyml] Runs launched per model, as by PhymlExecutor, keep fixed parameters"""
+        with cl.Phyml('alignments/phylip_primates/chr1_1036.phylip', pth='../binaries',
+                parameters={'pinv': 0.2}, starting_tree='(a,b,c);') as phyml:
+            template = phyml._model_template('JC69I')
+            assert template == phyml._user_tree_template(
+                    phyml._fixed_parameters_template('JC69I', {'pinv': 0.2}), phyml.starting_tree)
+
+    def test_run_fixed_parameters(self):
+        """[Phyml] Fixing the parameters fitted by a run keeps its lnl"""
+        for model in ['HKYIG', 'GTRIG']:
+            with cl.Phyml('alignments/phylip_primates/chr1_1036.phylip', pth='../binaries') as phyml:
+                statfile, treefile = phyml._runner(phyml.phylip, phyml.models[model], model)
+                lnl = phyml._get_log_like(statfile, phyml.ll, phyml.phylip)
+                parameters = phyml._get_parameters(statfile)
+            with cl.Phyml('alignments/phylip_primates/chr1_1036.phylip', pth='../binaries',
+                    parameters=parameters) as phyml:
+                observed = phyml.run(model)
+            self.assertAlmostEqual(float(observed[0]), lnl, 2)
+
+    def test_run_datasets(self):
+        """[Phyml] Phyml.run_datasets() matches Phyml.run() of each data set"""
+        loci = ['chr1_1036', 'chr1_1039', 'chr1_1036']
+        alns = [cl.iter_phylip(open('alignments/phylip_primates/%s.phylip' % locus)).next() for locus in loci]
+        with cl.Phyml(alns, pth='../binaries') as phyml:
+            observed = phyml.run_datasets('HKY')
+        assert len(observed) == 3
+        for aln, (lnl, tree) in zip(alns, observed):
+            with cl.Phyml(aln, pth='../binaries') as phyml:
+                expected = phyml.run('HKY')
+            self.assertAlmostEqual(float(lnl), float(expected[0]), 2)
+            distance = self.get_tree_distances(tree, expected[1])
+            self.assertAlmostEqual(distance, 0.0, 2)
+
     def test_run(self):
         """[Phyml] Phyml.run()"""
         expected = cPickle.load(open('pickles/gtr_lnl_and_model.pickle'))
@@ -247,6 +563,308 @@ class TestPhymlMethods(unittest.TestCase):
         self.assertAlmostEqual(float(observed[0]), float(expected[0]), 2)
 
 
+class TestFastTreeMethods(unittest.TestCase):
+
+    def setUp(self):
+        self.fasttree = cl.FastTree('alignments/phylip_primates/chr1_1036.phylip', pth='../binaries', exe='FastTree')
+
+    def tearDown(self):
+        self.fasttree.close()
+
+    def test_backends(self):
+        """[FastTree] Backends are selected by name"""
+        assert cl.get_backend('phyml') is cl.Phyml
+        assert cl.get_backend('fasttree') is cl.FastTree
+        self.assertRaises(ValueError, cl.get_backend, 'raxml')
+
+    def test_bundled_binary(self):
+        """[FastTree] The bundled binary is only chosen where it runs"""
+        if platform.system() == 'Darwin':
+            assert self.fasttree._get_binary_pth('../binaries', None).endswith('FastTree')
+        else:
+            self.assertRaises(ValueError, cl.FastTree, 'alignments/phylip_primates/chr1_1036.phylip',
+                    pth='../binaries')
+
+    def test_nearest_model(self):
+        """[FastTree] phyml models map to the nearest FastTree model"""
+        assert self.fasttree._nearest_model('JC69') == 'JC69'
+        assert self.fasttree._nearest_model('JC69IG') == 'JC69G'
+        assert self.fasttree._nearest_model('HKYI') == 'GTR'
+        assert self.fasttree._nearest_model('K2PG') == 'GTRG'
+        self.assertRaises(KeyError, self.fasttree._nearest_model, 'WAG')
+
+    def test_command(self):
+        """[FastTree] FastTree is run on the alignment with the model options"""
+        # echo writes its arguments where FastTree writes the tree
+        with cl.FastTree('alignments/phylip_primates/chr1_1036.phylip', pth='/bin', exe='echo',
+                starting_tree='(a,b,c);') as fasttree:
+            process, (logfile, treefile) = fasttree._launch_model('GTRG', fasttree.phylip)
+            process.wait()
+            observed = open(treefile).read().split()
+        assert observed == ['-nt', '-quiet', '-nopr', '-nosupport', '-log', logfile, '-gtr', '-gamma',
+                '-intree', fasttree.starting_tree, fasttree.phylip]
+
+    def test_log_like(self):
+        """[FastTree] Parse lnl from the FastTree log"""
+        log = os.path.join(self.fasttree.working, 'log')
+        lines = [
+                'TreeLogLk\tML_Lengths1\t-1016.2000',
+                'TreeLogLk\tML_NNI1\t-1010.1000\tMaxChange\t0.0100',
+                'TreeLogLk\tLength1\t-1009.5000\tMaxChange\t0.0010',
+            ]
+        open(log, 'w').write('\n'.join(lines) + '\n')
+        assert self.fasttree._get_log_like(log) == -1009.5
+        open(log, 'a').write('Gamma20LogLk\t-1002.250\tApproximate\tAlpha\t0.500\tRescale\t1.100\n')
+        assert self.fasttree._get_log_like(log) == -1002.25
+        open(log, 'w').write('')
+        self.assertRaises(ValueError, self.fasttree._get_log_like, log)
+
+    def test_constraint_tree(self):
+        """[FastTree] Constraint trees are refused"""
+        self.assertRaises(ValueError, cl.FastTree, 'alignments/phylip_primates/chr1_1036.phylip',
+                pth='../binaries', starting_tree='(a,b,c);', constraint_tree='(a,b,c);')
+
+
+class TestAlignment(unittest.TestCase):
+
+    def setUp(self):
+        self.one = open('alignments/3.oneliners', 'rU').readline()
+        self.locus = self.one.strip().split(';')[0]
+
+    def test_from_oneliner(self):
+        """[Alignment] Oneliner to alignment"""
+        aln = cl.Alignment.from_oneliner(self.locus)
+        assert aln.name == 'chr1_1036'
+        assert aln.model is None
+        assert aln.taxa == ['MusMuscu', 'GorGoril', 'PanTrogl']
+        assert aln.bases.dtype == 'uint8'
+        assert aln.bases.flags['C_CONTIGUOUS']
+        exp_align = cPickle.load(open('pickles/expected_align_to_array.pickle'))
+        assert (aln.bases.view('S1') == exp_align).all()
+
+    def test_to_oneliner(self):
+        """[Alignment] Alignment to oneliner"""
+        aln = cl.Alignment.from_oneliner(self.locus)
+        assert aln.to_oneliner({'chrm': 'chr1_1036'}) == self.locus
+
+    def test_to_phylip(self):
+        """[Alignment] Alignment to phylip"""
+        expected = cPickle.load(open('pickles/expected_phylip.pickle'))
+        observed = cl.Alignment.from_oneliner(self.locus).to_phylip()
+        assert observed == expected
+
+    def test_take(self):
+        """[Alignment] Resample columns"""
+        aln = cl.Alignment.from_oneliner(self.locus)
+        columns = [0, 0, 5, aln.nchar - 1]
+        observed = aln.take(columns)
+        assert observed.taxa == aln.taxa
+        assert observed.nchar == 4
+        for row, seq in enumerate(aln.sequences()):
+            assert observed.sequences()[row] == ''.join([seq[c] for c in columns])
+
+    def test_unequal_sequences(self):
+        """[Alignment] Unequal sequence lengths raise"""
+        self.assertRaises(ValueError, cl.Alignment.from_sequences, ['a', 'b'], ['ACGT', 'ACG'])
+
+    def test_site_patterns(self):
+        """[Alignment] Compress to unique site patterns"""
+        aln = cl.Alignment.from_sequences(['a', 'b'], ['AAGTA', 'CCGTC'])
+        patterns = aln.site_patterns()
+        assert patterns.npatterns == 3
+        assert patterns.nchar == aln.nchar
+        observed = dict(zip([c.tostring() for c in patterns.patterns.T], patterns.counts))
+        assert observed == {'AC': 3, 'GG': 1, 'TT': 1}
+
+    def test_site_pattern_bootstrap(self):
+        """[Alignment] Bootstrap weights over site patterns"""
+        aln = cl.Alignment.from_oneliner(self.locus)
+        patterns = aln.site_patterns()
+        weights = patterns.bootstrap_weights()
+        assert len(weights) == patterns.npatterns
+        assert weights.sum() == aln.nchar
+        expanded = patterns.expand(weights)
+        assert expanded.taxa == aln.taxa
+        assert expanded.nchar == aln.nchar
+        # every column of the replicate is a column of the original
+        original = set([c.tostring() for c in aln.bases.T])
+        assert set([c.tostring() for c in expanded.bases.T]) <= original
+
+    def test_phyml_accepts_alignment(self):
+        """[Alignment] Phyml writes alignments to its working dir"""
+        aln = cl.Alignment.from_oneliner(self.locus)
+        phyml = cl.Phyml(aln, pth='../binaries')
+        assert open(phyml.phylip).read() == aln.to_phylip()
+
+
+class TestDataset(unittest.TestCase):
+
+    def setUp(self):
+        self.working = tempfile.mkdtemp()
+        self.path = os.path.join(self.working, 'loci.cfds')
+        self.alignments = []
+        for line in open('alignments/3.oneliners', 'rU'):
+            self.alignments.append(cl.Alignment.from_oneliner(line))
+        self.alignments[1].model = 'HKY'
+
+    def tearDown(self):
+        shutil.rmtree(self.working)
+
+    def test_round_trip(self):
+        """[Dataset] Write and read all loci"""
+        cl.write_dataset(self.path, self.alignments)
+        reader = cl.DatasetReader(self.path)
+        assert len(reader) == 3
+        assert reader.names() == ['chr1_1036', 'chr1_1039', 'chr1_1057']
+        for expected, observed in zip(self.alignments, reader):
+            assert observed.name == expected.name
+            assert observed.model == expected.model
+            assert observed.taxa == expected.taxa
+            assert (observed.bases == expected.bases).all()
+        reader.close()
+
+    def test_random_access(self):
+        """[Dataset] Read a single locus by name"""
+        cl.write_dataset(self.path, self.alignments)
+        with cl.DatasetReader(self.path) as reader:
+            assert 'chr1_1039' in reader
+            entry = reader.index[1]
+            assert (entry.ntax, entry.nchar) == (self.alignments[1].ntax, self.alignments[1].nchar)
+            observed = reader['chr1_1039']
+        # alignments outlive the reader
+        assert observed.model == 'HKY'
+        assert observed.to_phylip() == self.alignments[1].to_phylip()
+
+    def test_duplicate_locus(self):
+        """[Dataset] Duplicate loci raise"""
+        with cl.DatasetWriter(self.path) as writer:
+            writer.write(self.alignments[0])
+            self.assertRaises(ValueError, writer.write, self.alignments[0])
+
+    def test_not_a_dataset(self):
+        """[Dataset] Reading other files raises"""
+        self.assertRaises(IOError, cl.DatasetReader, 'alignments/3.oneliners')
+
+
+class TestResultCache(unittest.TestCase):
+
+    def setUp(self):
+        self.working = tempfile.mkdtemp()
+        self.cache = cl.ResultCache(os.path.join(self.working, 'cache'))
+
+    def tearDown(self):
+        shutil.rmtree(self.working)
+
+    def test_get_and_put(self):
+        """[ResultCache] Store and retrieve results"""
+        key = self.cache.key('alignment', 'GTR')
+        assert key != self.cache.key('alignment', 'HKY')
+        assert self.cache.get(key) is None
+        self.cache.put(key, {'lnl': '-1.0', 'tree': '(a,b,c);'})
+        assert self.cache.get(key) == {'lnl': '-1.0', 'tree': '(a,b,c);'}
+
+    def test_evict_least_recently_used(self):
+        """[ResultCache] Evict least recently used entries beyond max_size"""
+        self.cache.put('a', 'x' * 100)
+        self.cache.put('b', 'x' * 100)
+        # make a the most recently used
+        os.utime(self.cache._entry('b'), (0, 0))
+        self.cache.get('a')
+        self.cache.max_size = 150
+        self.cache.evict()
+        assert self.cache.get('a') is not None
+        assert self.cache.get('b') is None
+
+    def test_put_evicts_beyond_max_size(self):
+        """[ResultCache] put() keeps a running size and evicts beyond max_size"""
+        self.cache.put('a', 'x' * 100)
+        cache = cl.ResultCache(os.path.join(self.working, 'cache'), max_size=250)
+        assert cache.size == os.path.getsize(cache._entry('a'))
+        os.utime(cache._entry('a'), (0, 0))
+        cache.put('b', 'x' * 100)
+        assert cache.get('a') is not None
+        cache.put('c', 'x' * 100)
+        assert cache.get('a') is None
+        assert cache.size == sum([os.path.getsize(cache._entry(key)) for key in 'bc'])
+
+    def test_phyml_uses_cache(self):
+        """[ResultCache] Phyml.run() returns cached results without running phyml"""
+        phyml = cl.Phyml('alignments/phylip_primates/chr1_1036.phylip', pth='../binaries', cache=self.cache)
+        key = phyml._cache_key('run', phyml.models['GTR'])
+        self.cache.put(key, {'lnl': '-1.0', 'tree': '(a,b,c);'})
+        # formatting differences in the alignment do not change the key
+        phylip = open('alignments/phylip_primates/chr1_1036.phylip', 'rU').read()
+        other = cl.Phyml(phylip.replace('\n', '\n\n'), pth='../binaries', cache=self.cache)
+        assert other.run('GTR') == ('-1.0', '(a,b,c);')
+
+
+class TestCostModel(unittest.TestCase):
+
+    def setUp(self):
+        self.records = [
+            {'locus': 'a', 'stage': 'model selection', 'ntax': 10, 'nchar': 500, 'patterns': 100, 'wall': 2.},
+            {'locus': 'a', 'stage': 'model selection', 'ntax': 10, 'nchar': 500, 'patterns': 100, 'wall': 2.},
+            {'locus': 'b', 'stage': 'model selection', 'ntax': 10, 'nchar': 500, 'patterns': 100, 'wall': 6.},
+            {'locus': 'b', 'stage': 'model selection', 'ntax': 10, 'nchar': 500, 'patterns': 100, 'wall': 6.},
+        ]
+
+    def test_uncalibrated(self):
+        """[CostModel] Without telemetry costs are ntax * site patterns"""
+        cost_model = cl.CostModel()
+        assert not cost_model.calibrated
+        assert cost_model.cost(10, 100) == 1000.
+        assert cost_model.runs_per_locus('model selection') == 1.
+
+    def test_calibrated(self):
+        """[CostModel] Telemetry calibrates seconds per unit, per stage and per locus"""
+        cost_model = cl.CostModel(self.records)
+        assert cost_model.calibrated
+        # 16 s over 4000 units
+        assert cost_model.cost(10, 200, 'model selection') == 8.
+        # other stages fall back to the rate of all stages
+        assert cost_model.cost(10, 200, 'bootstrap') == 8.
+        # locus b ran slower than predicted
+        assert cost_model.cost(10, 100, 'model selection', 'a') == 2.
+        assert cost_model.cost(10, 100, 'model selection', 'b') == 6.
+        assert cost_model.runs_per_locus('model selection') == 2.
+
+
+class TestRunManifest(unittest.TestCase):
+
+    def setUp(self):
+        self.working = tempfile.mkdtemp()
+        self.path = os.path.join(self.working, 'manifest.jsonl')
+
+    def tearDown(self):
+        shutil.rmtree(self.working)
+
+    def test_resume(self):
+        """[RunManifest] Resuming keeps whole records and drops a cut short one"""
+        manifest = cl.RunManifest(self.path)
+        manifest.write({'stage': 'genetree', 'locus': 'a'})
+        manifest.write({'stage': 'bootreps', 'rep': 1})
+        manifest.close()
+        with open(self.path, 'a') as fout:
+            fout.write('{"stage": "boo')
+        manifest = cl.RunManifest(self.path, resume=True)
+        assert manifest.get('genetree') == [{'stage': 'genetree', 'locus': 'a'}]
+        offset = manifest.write({'stage': 'bootreps', 'rep': 2})
+        assert manifest.read(offset) == {'stage': 'bootreps', 'rep': 2}
+        manifest.close()
+        manifest = cl.RunManifest(self.path, resume=True)
+        assert [record['rep'] for record in manifest.get('bootreps')] == [1, 2]
+        manifest.close()
+
+    def test_fresh(self):
+        """[RunManifest] Without resume the manifest starts empty"""
+        manifest = cl.RunManifest(self.path)
+        manifest.write({'stage': 'genetree', 'locus': 'a'})
+        manifest.close()
+        manifest = cl.RunManifest(self.path)
+        assert manifest.get('genetree') == []
+        manifest.close()
+
+
 class TestCoreFunctions(unittest.TestCase):
 
     def setUp(self):
@@ -261,6 +879,51 @@ class TestCoreFunctions(unittest.TestCase):
         expected = 'chrm=test:gor_gor,---ATCATAGTTGAA,oto_gar,GTAATCATAGTTGAA;'
         assert observed == expected
 
+    def test_iter_phylip_interleaved(self):
+        """[Phylip] Interleaved phylip to alignment"""
+        phylip = open('alignments/phylip_primates/chr1_1036.phylip', 'rU')
+        alignments = [aln for aln in cl.iter_phylip(phylip, 'chr1_1036')]
+        assert len(alignments) == 1
+        aln = alignments[0]
+        assert (aln.ntax, aln.nchar) == (10, 430)
+        assert aln.taxa[0] == 'mus_mus'
+        assert aln.name == 'chr1_1036'
+        assert aln.sequences()[0].startswith('----TCCTAGCTGAACAGAG')
+
+    def test_iter_phylip_sequential(self):
+        """[Phylip] Sequential phylip to alignment"""
+        phylip = ['2 8', 'taxon_a ACGT', 'ACGT', 'taxon_b', 'TTTT TTTT']
+        aln = cl.iter_phylip(phylip, interleaved=False).next()
+        assert aln.taxa == ['taxon_a', 'taxon_b']
+        assert aln.sequences() == ['ACGTACGT', 'TTTTTTTT']
+
+    def test_iter_phylip_concatenated(self):
+        """[Phylip] Concatenated phylip alignments are parsed lazily"""
+        phylip = ['2 4', 'a ACGT', 'b AC-T', '', '3 2', 'a AA', 'b CC', 'c GG']
+        alignments = cl.iter_phylip(iter(phylip))
+        first = alignments.next()
+        assert first.sequences() == ['ACGT', 'AC-T']
+        second = alignments.next()
+        assert second.taxa == ['a', 'b', 'c']
+        self.assertRaises(StopIteration, alignments.next)
+
+    def test_iter_phylip_strict(self):
+        """[Phylip] Strict phylip names of 10 characters may touch the sequence"""
+        phylip = ['2 4', 'taxon_abcdACGT', 'taxon_b   AC-T']
+        aln = cl.iter_phylip(phylip).next()
+        assert aln.taxa == ['taxon_abcd', 'taxon_b']
+        assert aln.sequences() == ['ACGT', 'AC-T']
+        phylip = ['2 4', 'Homo sap. ACGT', 'Pan trog. AC-T']
+        aln = cl.iter_phylip(phylip, strict=True).next()
+        assert aln.taxa == ['Homo sap.', 'Pan trog.']
+        self.assertRaises(ValueError, list, cl.iter_phylip(['1 4', 'taxon_abcdACGTA']))
+        self.assertRaises(ValueError, list, cl.iter_phylip(phylip))
+
+    def test_iter_phylip_truncated(self):
+        """[Phylip] Taxa of unequal length raise"""
+        phylip = ['2 4', 'a ACGT', 'b AC']
+        self.assertRaises(ValueError, list, cl.iter_phylip(phylip))
+
     def test_phyml_to_oneliner(self):
         phylip = open('alignments/phylip_primates/chr1_1036.phylip', 'rU').read()
         observed = cl.phylip_to_oneliner(phylip, 'chr1_1036')
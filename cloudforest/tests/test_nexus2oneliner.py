@@ -7,6 +7,8 @@ Brant C. Faircloth. All rights reserved.
 Tests functions in nexus2oneliners.py
 """
 
+import sys
+import StringIO
 import textwrap
 import unittest
 from cloudforest import nexus2oneliner
@@ -71,6 +73,49 @@ class TestNexus2OnelinereFunctions(unittest.TestCase):
 		self.assertEqual(result, test_str)
 
 
+	def test_nexus2oneliner_interleaved(self):
+		nexus = ["#NEXUS", "begin data;", "matrix", "homo_sapiens ACGT", "pan_troglodytes ????",
+			"", "homo_sapiens AC", "pan_troglodytes --", ";", "end;"]
+		result = nexus2oneliner.nexus2oneliner(nexus, self.name)
+		self.assertEqual(result, "chrm=test_nexus:HomSapie,ACGTAC;\n")
+
+	def test_nexus2oneliner_concatenated(self):
+		nexus = textwrap.dedent(self.nexus).split("\n")
+		result = nexus2oneliner.nexus2oneliner(nexus + nexus, self.name)
+		first, second = result.splitlines()
+		self.assertEqual(first + "\n", textwrap.dedent(self.oneliner).replace("\t", ""))
+		self.assertTrue(second.startswith("chrm=test_nexus_2:MusMuscu,"))
+
+	def test_nexus2oneliner_mask_ambiguous(self):
+		nexus = ["#NEXUS", "begin data;", "matrix", "homo_sapiens ACNTR", "pan_troglodytes NNNN?",
+			";", "end;"]
+		result = nexus2oneliner.nexus2oneliner(nexus, self.name)
+		self.assertEqual(result, "chrm=test_nexus:HomSapie,ACNTR,PanTrogl,NNNN?;\n")
+		result = nexus2oneliner.nexus2oneliner(nexus, self.name, mask=True)
+		# taxa left without data once masked are dropped
+		self.assertEqual(result, "chrm=test_nexus:HomSapie,AC-T-;\n")
+
+	def test_nexus2oneliner_matrix_command(self):
+		nexus = ["#NEXUS", "[ distance matrix omitted ]", "begin data;", "dimensions ntax=1 nchar=4;",
+			"  MATRIX", "homo_sapiens ACGT", ";", "end;"]
+		result = nexus2oneliner.nexus2oneliner(nexus, self.name)
+		self.assertEqual(result, "chrm=test_nexus:HomSapie,ACGT;\n")
+
+	def test_nexus2oneliner_no_taxa(self):
+		nexus = ["#NEXUS", "begin data;", "matrix", "homo_sapiens ????", ";", "end;"]
+		nexus += ["#NEXUS", "begin data;", "matrix", "homo_sapiens ACGT", ";", "end;"]
+		stderr = sys.stderr
+		sys.stderr = StringIO.StringIO()
+		try:
+			result = nexus2oneliner.nexus2oneliner(nexus, self.name)
+			warning = sys.stderr.getvalue()
+		finally:
+			sys.stderr = stderr
+		# the alignment left without taxa is skipped, keeping the names of the others
+		self.assertEqual(result, "chrm=test_nexus_2:HomSapie,ACGT;\n")
+		self.assertTrue("test_nexus has no taxa" in warning)
+
+
 if __name__ == '__main__':
 	suite = unittest.TestLoader().loadTestsFromTestCase(TestNexus2OnelinereFunctions)
 	unittest.TextTestRunner(verbosity=3).run(suite)
\ No newline at end of file
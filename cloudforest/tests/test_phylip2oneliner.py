@@ -1,6 +1,10 @@
+import os
+import shutil
+import tempfile
 import textwrap
 import unittest
 from cloudforest import phylip2oneliner
+from cloudforest.core import Alignment, DatasetWriter, DatasetReader
 
 class TestPhylip2OnelinerFunctions(unittest.TestCase):
 
@@ -50,6 +54,29 @@ class TestPhylip2OnelinerFunctions(unittest.TestCase):
 		oneliner = phylip2oneliner.parsePhylip(lines, self.name)
 		self.assertEqual(oneliner, self.result)
 
+	def test_parsePhylip_concatenated(self):
+		lines = ['2 4', 'a ACGT', 'b AC-T', '', '3 2', 'a AA', 'b CC', 'c GG']
+		oneliners = phylip2oneliner.parsePhylip(lines, 'loc').splitlines()
+		self.assertEqual([o.split(':')[0] for o in oneliners], ['chrm=loc', 'chrm=loc_2'])
+		working = tempfile.mkdtemp()
+		try:
+			path = os.path.join(working, 'loci.cfds')
+			writer = DatasetWriter(path)
+			for oneliner in oneliners:
+				writer.write(Alignment.from_oneliner(oneliner))
+			writer.close()
+			reader = DatasetReader(path)
+			self.assertEqual([aln.name for aln in reader], ['loc', 'loc_2'])
+			self.assertEqual(sorted(reader['loc_2'].taxa), ['a', 'b', 'c'])
+			reader.close()
+		finally:
+			shutil.rmtree(working)
+
+	def test_parsePhylip_strict(self):
+		lines = ['2 4', 'Homo sap. ACGT', 'Pan trog. AC-T']
+		oneliner = phylip2oneliner.parsePhylip(lines, 'loc', strict=True)
+		self.assertEqual(sorted(oneliner.split(':')[1].rstrip(';\n').split(',')[::2]), ['Homo sap.', 'Pan trog.'])
+
 
 if __name__ == '__main__':
 	suite = unittest.TestLoader().loadTestsFromTestCase(TestPhylip2OnelinerFunctions)
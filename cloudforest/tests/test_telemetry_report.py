@@ -0,0 +1,42 @@
+"""
+test_telemetry_report.py
+
+Tests functions in telemetry_report.py
+"""
+
+import unittest
+from cloudforest import telemetry_report
+
+class TestTelemetryReportFunctions(unittest.TestCase):
+
+	def setUp(self):
+		self.records = [
+			{'locus': 'chr1', 'model': 'GTR', 'stage': 'bootstrap', 'ntax': 10, 'nchar': 430,
+				'wall': 2.0, 'user': 1.5, 'sys': 0.5, 'maxrss': 100},
+			{'locus': 'chr2', 'model': 'GTR', 'stage': 'bootstrap', 'ntax': 10, 'nchar': 100,
+				'wall': 1.0, 'user': 0.5, 'sys': 0.0, 'maxrss': 200},
+			{'locus': 'chr1', 'model': 'HKY', 'stage': 'model selection', 'ntax': 10, 'nchar': 430,
+				'wall': 1.0, 'user': 1.0, 'sys': 0.0, 'maxrss': 50},
+		]
+
+	def test_sizeBucket(self):
+		self.assertEqual(telemetry_report.sizeBucket(self.records[0]), '4096-8191')
+		self.assertEqual(telemetry_report.sizeBucket(self.records[1]), '512-1023')
+
+	def test_summarizeTelemetry(self):
+		groups = telemetry_report.summarizeTelemetry(self.records, ['model'])
+		self.assertEqual(sorted(groups.keys()), [('GTR',), ('HKY',)])
+		self.assertEqual(groups[('GTR',)], {'runs': 2, 'wall': 3.0, 'cpu': 2.5, 'maxrss': 200})
+
+	def test_formatReport(self):
+		groups = telemetry_report.summarizeTelemetry(self.records, ['stage', 'size'])
+		lines = telemetry_report.formatReport(groups, ['stage', 'size']).splitlines()
+		self.assertEqual(lines[0].split('\t')[:3], ['stage', 'size', 'runs'])
+		# most CPU time first
+		self.assertEqual(lines[1].split('\t')[:3], ['bootstrap', '4096-8191', '1'])
+		self.assertEqual(len(lines), 4)
+
+
+if __name__ == '__main__':
+	suite = unittest.TestLoader().loadTestsFromTestCase(TestTelemetryReportFunctions)
+	unittest.TextTestRunner(verbosity=3).run(suite)
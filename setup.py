@@ -41,6 +41,8 @@ setup(
     scripts = [
               'cloudforest/nexus2oneliner.py',
               'cloudforest/phylip2oneliner.py',
+              'cloudforest/oneliner2dataset.py',
+              'cloudforest/telemetry_report.py',
               'cloudforest/process.py'
               ],
 )